@@ -2,40 +2,62 @@ import copy
 import coffea.processor as processor
 import re
 import numpy as np
-from dynaconf import settings as cfg
 
-from coffea.lumi_tools import LumiMask
+from jmecofftea.helpers.lumi import get_lumi_mask
 
 from jmecofftea.hlt.definitions import hlt_accumulator
 from jmecofftea.helpers import jmecofftea_path, recoil, metnomu, mask_and, mask_or, object_overlap
 from jmecofftea.helpers.dataset import extract_year
 from jmecofftea.helpers.paths import jmecofftea_path
+from jmecofftea.helpers.config import load_config, config_hash
+from jmecofftea.helpers.selection import RegionSelection, efficiency_regions
 
-from jmecofftea.custom_nano.definitions import regionsForCustomNanoProcessor
+from jmecofftea.custom_nano.definitions import regionsForCustomNanoProcessor, CUSTOM_NANO_TRIGGERS
 
 class customNanoProcessor(processor.ProcessorABC):
     def __init__(self):
-        self._accumulator = hlt_accumulator()
+        # Resolve the configuration once, the frozen snapshot is pickled together
+        # with the processor so that workers do not need to read it again
+        self._cfg = load_config(jmecofftea_path("config/hlt.yaml"))
+        self._cfg_hash = config_hash(self._cfg)
+
+        self._accumulator = hlt_accumulator(efficiency=self._cfg.RUN.EFFICIENCY_MODE)
 
     @property
     def accumulator(self):
         return self._accumulator
 
-    def _configure(self, df=None):
-        cfg.DYNACONF_WORKS="merge_configs"
-        cfg.MERGE_ENABLED_FOR_DYNACONF = True
-        cfg.SETTINGS_FILE_FOR_DYNACONF = jmecofftea_path("config/hlt.yaml")
+    @property
+    def config_hash(self):
+        return self._cfg_hash
+
+    @property
+    def columns(self):
+        """
+        Branches needed for every chunk. The executor reads them in one bulk
+        call before process() is called, any other branch is still read on demand.
+        """
+        columns = [
+            'run',
+            'luminosityBlock',
+            'leadingJet_pt',
+            'ht',
+            'met',
+        ]
+        for trigger in CUSTOM_NANO_TRIGGERS:
+            columns += [
+                f"{trigger}_HLTPathAccept",
+                f"{trigger}_HLTPathPrescaled",
+                f"{trigger}_L1TSeedPrescaledOrMasked",
+                f"{trigger}_L1TSeedAccept",
+            ]
+        return columns
 
+    def _configure(self, df=None):
         if df:
             dataset = df['dataset']
             self._year = extract_year(dataset)
             df["year"] = self._year
-            
-            # Use the default config for now
-            cfg.ENV_FOR_DYNACONF = "default"
-        else:
-            cfg.ENV_FOR_DYNACONF = "default"
-        cfg.reload()
 
     def process(self, df):
         if not df.size:
@@ -43,9 +65,10 @@ class customNanoProcessor(processor.ProcessorABC):
         dataset = df['dataset']
 
         self._configure(df)
+        cfg = self._cfg
 
         # Implement selections
-        selection = processor.PackedSelection()
+        selection = RegionSelection()
 
         pass_all = np.ones(df.size)==1
 
@@ -54,7 +77,7 @@ class customNanoProcessor(processor.ProcessorABC):
         if df["year"] in cfg.LUMI_MASKS:
             # Pick the correct golden JSON for this year
             json = jmecofftea_path(cfg.LUMI_MASKS[df["year"]])
-            lumi_mask = LumiMask(json)(df["run"], df["luminosityBlock"])
+            lumi_mask = get_lumi_mask(json)(df["run"], df["luminosityBlock"])
         
         # If no golden JSON available, apply no filtering
         else:
@@ -63,25 +86,7 @@ class customNanoProcessor(processor.ProcessorABC):
         selection.add("lumi_mask", lumi_mask)
 
         # Triggers of interest
-        triggers = [
-            # Single jet paths
-            "HLT_PFJet60",
-            "HLT_PFJet80",
-            "HLT_PFJet140",
-            "HLT_PFJet320",
-            "HLT_PFJet500",
-            # Forward single jet paths
-            "HLT_PFJetFwd60",
-            "HLT_PFJetFwd80",
-            "HLT_PFJetFwd140",
-            "HLT_PFJetFwd320",
-            # HT paths
-            "HLT_PFHT180",
-            "HLT_PFHT350",
-            "HLT_PFHT510",
-            "HLT_PFHT780",
-            "HLT_PFHT1050",
-        ]
+        triggers = CUSTOM_NANO_TRIGGERS
 
         for trigger in triggers:
             # The given path has been accepted by HLT
@@ -97,16 +102,31 @@ class customNanoProcessor(processor.ProcessorABC):
             selection.add(f"{trigger}_L1TSeedAccept", df[f"{trigger}_L1TSeedAccept"])
 
         output = self.accumulator.identity()
+        output['config_hash'].add(self._cfg_hash)
 
         # Loop over regions for each trigger and fill histograms
         regions = regionsForCustomNanoProcessor(triggers)
 
-        for region, cuts in regions.items():
+        if cfg.RUN.EFFICIENCY_MODE:
+            # Fill each denominator region once, with the trigger decision on the pass axis
+            fill_regions = efficiency_regions(regions)
+        else:
+            fill_regions = {region : (cuts, None) for region, cuts in regions.items()}
+
+        for region, (cuts, pass_cuts) in fill_regions.items():
             # Get the selection mask for this region
             mask = selection.all(*cuts)
 
+            # Trigger decision for the events in the region (all pass if there is no trigger cut)
+            if cfg.RUN.EFFICIENCY_MODE:
+                passing = selection.all(*pass_cuts)[mask].astype(int) if pass_cuts else np.ones(mask.sum(), dtype=int)
+            else:
+                passing = None
+
             def ezfill(name, **kwargs):
                 """Helper function to make filling easier."""
+                if passing is not None:
+                    kwargs['pass'] = passing
                 output[name].fill(
                     region=region, 
                     dataset=dataset, 
@@ -4,6 +4,27 @@ import copy
 import coffea.processor as processor
 import numpy as np
 
+# Triggers of interest
+CUSTOM_NANO_TRIGGERS = [
+    # Single jet paths
+    "HLT_PFJet60",
+    "HLT_PFJet80",
+    "HLT_PFJet140",
+    "HLT_PFJet320",
+    "HLT_PFJet500",
+    # Forward single jet paths
+    "HLT_PFJetFwd60",
+    "HLT_PFJetFwd80",
+    "HLT_PFJetFwd140",
+    "HLT_PFJetFwd320",
+    # HT paths
+    "HLT_PFHT180",
+    "HLT_PFHT350",
+    "HLT_PFHT510",
+    "HLT_PFHT780",
+    "HLT_PFHT1050",
+]
+
 def regionsForCustomNanoProcessor(triggers):
     """
     Analysis regions for the customNanoProcessor.
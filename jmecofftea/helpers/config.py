@@ -0,0 +1,97 @@
+import json
+from collections.abc import Mapping
+
+import xxhash
+import yaml
+
+class FrozenConfig(Mapping):
+    """
+    Immutable snapshot of a nested configuration.
+
+    Nested mappings are converted to FrozenConfig objects and lists to tuples.
+    Values can be accessed both as items and as attributes. String keys are
+    case-insensitive, like in dynaconf, so that cfg.MUON.CUTS.TIGHT.ISO
+    keeps working, while iterating returns the keys as written in the YAML file.
+
+    The snapshot is a plain Python object, so it is pickled together with the
+    processor and does not need the file system or dynaconf on the worker.
+    """
+    def __init__(self, data):
+        items = {key : _freeze(value) for key, value in data.items()}
+        object.__setattr__(self, '_items', items)
+        object.__setattr__(self, '_keymap', {key.upper() : key for key in items if isinstance(key, str)})
+
+    def __getitem__(self, key):
+        if key in self._items:
+            return self._items[key]
+        if isinstance(key, str) and key.upper() in self._keymap:
+            return self._items[self._keymap[key.upper()]]
+        raise KeyError(key)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(f"Configuration has no entry: {name}")
+
+    def __setattr__(self, name, value):
+        raise TypeError("FrozenConfig objects are immutable.")
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return f"FrozenConfig({self.to_dict()!r})"
+
+    def __reduce__(self):
+        return (FrozenConfig, (self.to_dict(),))
+
+    def to_dict(self):
+        """Returns the configuration as nested plain dictionaries and lists."""
+        return {key : _thaw(value) for key, value in self._items.items()}
+
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return FrozenConfig(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    return value
+
+def _thaw(value):
+    if isinstance(value, FrozenConfig):
+        return value.to_dict()
+    if isinstance(value, tuple):
+        return [_thaw(x) for x in value]
+    return value
+
+def config_hash(config):
+    """
+    Returns a hash of the configuration content, for book keeping of
+    which configuration was used to produce a given output.
+    """
+    content = json.dumps(config.to_dict(), sort_keys=True, default=str)
+    return xxhash.xxh64(content.encode('utf-8')).hexdigest()
+
+def load_config(settings_file, env="default"):
+    """
+    Resolve the configuration once with dynaconf and return a frozen snapshot of it.
+
+    Only the top level settings defined in the given YAML file are kept,
+    internal dynaconf settings are dropped.
+    """
+    from dynaconf import settings as cfg
+    cfg.DYNACONF_WORKS="merge_configs"
+    cfg.MERGE_ENABLED_FOR_DYNACONF = True
+    cfg.SETTINGS_FILE_FOR_DYNACONF = settings_file
+    cfg.ENV_FOR_DYNACONF = env
+    cfg.reload()
+
+    with open(settings_file) as f:
+        keys = [key.upper() for key in yaml.safe_load(f)[env].keys()]
+
+    return FrozenConfig({key : cfg.get(key) for key in keys})
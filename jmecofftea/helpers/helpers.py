@@ -1,4 +1,7 @@
 from jmecofftea.helpers.paths import jmecofftea_path
+from collections import namedtuple
+import awkward
+import coffea
 import numpy as np
 
 def dphi(phi1, phi2):
@@ -149,6 +152,108 @@ def mask_and(df, masks):
             continue
     return decision
 
+LazyDataFrameInternals = namedtuple('LazyDataFrameInternals', ['tree', 'branchargs', 'columns', 'materialized'])
+
+def lazy_dataframe_internals(df):
+    """Private state of a coffea 0.6.x LazyDataFrame.
+
+    The LazyDataFrame has no public way to read several branches in one call,
+    or to get the tree it reads from. All access to its private attributes goes
+    through this function, which fails if the coffea version changes, instead of
+    silently falling back to reading every branch on its own.
+
+    :param df: Data frame
+    :type df: LazyDataFrame
+    :return: The tree, the arguments used to read its branches, the dictionary
+             of loaded columns and the set of columns read from the tree
+    :rtype: LazyDataFrameInternals
+    """
+    if not coffea.__version__.startswith('0.6.'):
+        raise RuntimeError(f"lazy_dataframe_internals() supports coffea 0.6.x only, found coffea {coffea.__version__}.")
+    try:
+        return LazyDataFrameInternals(df._tree, df._branchargs, df._dict, df._materialized)
+    except AttributeError as e:
+        raise RuntimeError(f"Unexpected LazyDataFrame layout for coffea {coffea.__version__}: {e}")
+
+def lazy_branch(df, branch, size, function=None, dtype=None):
+    """Returns a flat branch of the data frame as a virtual array,
+    which is only read from the file once its content is accessed.
+
+    Can be used as a column of a JaggedCandidateArray, so that attributes
+    which are never used by the processor are never read.
+
+    :param df: Data frame
+    :type df: LazyDataFrame
+    :param branch: Name of the (flattened) branch
+    :type branch: str
+    :param size: Length of the flattened branch, i.e. the sum of the counts
+    :type size: int
+    :param function: Optional function to apply to the branch content
+    :type function: callable
+    :param dtype: Type of the resulting array, by default the type of the branch.
+                  Has to be specified if a function is given.
+    :type dtype: numpy.dtype
+    :return: Virtual array with the branch content
+    :rtype: awkward.VirtualArray
+    """
+    if dtype is None:
+        if function is not None:
+            raise ValueError(f"A dtype has to be specified for branch {branch} if a function is given.")
+        interpretation = lazy_dataframe_internals(df).tree[branch].interpretation
+        # Jagged branches are read flattened, take the type of the content
+        dtype = getattr(interpretation, 'content', interpretation).todtype
+    dtype = np.dtype(dtype)
+
+    def read():
+        content = df[branch]
+        if function is not None:
+            content = function(content)
+        return content.astype(dtype, copy=False)
+
+    # Declaring the type up front avoids reading the branch to determine its length
+    return awkward.VirtualArray(read, type=awkward.type.ArrayType(size, dtype))
+
+class LeadingObjectView(object):
+    """Flat per-event view of one object per event, e.g. the leading jet.
+
+    Every attribute of the candidates is available as a flat numpy array with
+    one entry per event, which is NaN (False for boolean attributes) for events
+    without the object. Each attribute is gathered from the jagged array only once,
+    on first access, so attributes that are never used are never read.
+
+    :param candidates: Candidates to pick the object from
+    :type candidates: JaggedCandidateArray
+    :param index: Jagged index of the object in each event, e.g. candidates.pt.argmax()
+    :type index: JaggedArray
+    :param overrides: Jagged arrays to use instead of attributes of the candidates,
+                      e.g. pt=varied_pt for a systematic variation
+    :type overrides: JaggedArray
+    """
+    def __init__(self, candidates, index, **overrides):
+        self._selected = candidates[index]
+        self._index = index
+        self._overrides = overrides
+        # Whether the event has the object
+        self.valid = self._selected.counts > 0
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        if attr in self._overrides:
+            content = self._overrides[attr][self._index].flatten()
+        else:
+            content = getattr(self._selected, attr).flatten()
+        if content.dtype == np.dtype('bool'):
+            values = np.zeros(self.valid.shape, dtype=bool)
+        elif np.issubdtype(content.dtype, np.floating):
+            values = np.full(self.valid.shape, np.nan, dtype=content.dtype)
+        else:
+            values = np.full(self.valid.shape, np.nan)
+        values[self.valid] = content
+        # Cache the result, __getattr__ is not called again for this attribute
+        setattr(self, attr, values)
+        return values
+
 
 from coffea.lookup_tools import extractor
 
@@ -0,0 +1,103 @@
+"""Vectorized filling of coffea histograms"""
+
+import numpy as np
+import coffea
+from coffea.hist.hist_tools import DenseAxis
+
+def _check_hist_internals(histogram):
+    """
+    fill_regions() updates the sums of weights of the histogram directly,
+    which are private attributes of coffea 0.6.x histograms. Fail instead of
+    silently filling wrong attributes if the coffea version changes.
+    """
+    if not coffea.__version__.startswith('0.6.'):
+        raise RuntimeError(f"fill_regions() supports coffea 0.6.x only, found coffea {coffea.__version__}.")
+    if not all(hasattr(histogram, attr) for attr in ('_sumw', '_sumw2', '_dtype', '_init_sumw2')):
+        raise RuntimeError(f"Unexpected histogram layout for coffea {coffea.__version__}.")
+
+def fill_regions(histogram, regions, membership, counts=None, **values):
+    """
+    Fill a histogram for many regions at once.
+
+    Equivalent to calling histogram.fill(region=region, **values) with the values
+    of the events in each region, but the bins of all regions are computed once
+    and filled with a single np.bincount call. Like for Hist.fill(), the sum of
+    squared weights is stored once a weight is given. For unweighted fills into an
+    empty histogram, the result is bit-identical to the per-region fills. Weighted
+    fills agree up to floating point rounding.
+
+    :param histogram: Histogram with a "region" axis
+    :type histogram: coffea.hist.Hist
+    :param regions: Names of the regions to fill
+    :type regions: list
+    :param membership: Boolean array of shape (number of regions, number of events),
+                       whether each event is in each region
+    :type membership: numpy.ndarray
+    :param counts: Number of entries per event, if the dense values are jagged
+                   quantities flattened over all events. Otherwise, one entry per event.
+    :type counts: numpy.ndarray
+    :param values: Values for the other axes. Literals for sparse axes, arrays for dense axes.
+                   Dense values can also differ between regions, given as an array of shape
+                   (number of regions, number of events). The reserved keyword "weight"
+                   gives the weight of each entry, in the same way as the dense values.
+    """
+    _check_hist_internals(histogram)
+    axis_names = [ax.name for ax in histogram.axes()]
+    missing = [name for name in axis_names if name != 'region' and name not in values]
+    if missing:
+        raise ValueError(f"Not all axes specified for {histogram!r}. Missing: {', '.join(missing)}")
+    extra = [name for name in values if name not in axis_names and name != 'weight']
+    if extra:
+        raise ValueError(f"Unrecognized axes specified for {histogram!r}. Extraneous: {', '.join(extra)}")
+
+    if counts is not None:
+        # Expand the per-event arrays to one entry per jagged entry
+        membership = np.repeat(membership, counts, axis=1)
+        values = {
+            name : np.repeat(value, counts, axis=1) if getattr(value, 'ndim', 0) == 2 else value
+            for name, value in values.items()
+        }
+    weight = values.pop('weight', None)
+
+    dense_axes = [ax for ax in histogram.axes() if isinstance(ax, DenseAxis)]
+    dense_shape = tuple(ax.size for ax in dense_axes)
+    nbins = int(np.prod(dense_shape))
+
+    # Flat index of the dense bin of every entry, per region if any value differs per region
+    dense_indices = []
+    for ax in dense_axes:
+        value = np.asarray(values[ax.name])
+        dense_indices.append(ax.index(value.ravel()).reshape(value.shape if value.ndim == 2 else (1, value.size)))
+    bin_index = np.ravel_multi_index(np.broadcast_arrays(*dense_indices), dense_shape)
+
+    # Combined (region, bin) index of every entry that is in a region
+    region_index, entry_index = np.nonzero(membership)
+    row_index = region_index if bin_index.shape[0] > 1 else 0
+    index = region_index * nbins + bin_index[row_index, entry_index]
+    shape = (len(regions),) + dense_shape
+
+    if weight is None:
+        sumw = np.bincount(index, minlength=len(regions) * nbins).reshape(shape)
+        # Unweighted entries: sumw2 equals sumw
+        sumw2 = sumw
+    else:
+        weight = np.asarray(weight, dtype=float)
+        if weight.ndim == 2:
+            weight = weight[region_index, entry_index]
+        else:
+            weight = np.broadcast_to(weight, membership.shape[1:])[entry_index]
+        sumw = np.bincount(index, weights=weight, minlength=len(regions) * nbins).reshape(shape)
+        sumw2 = np.bincount(index, weights=weight**2, minlength=len(regions) * nbins).reshape(shape)
+        if histogram._sumw2 is None:
+            histogram._init_sumw2()
+
+    for i, region in enumerate(regions):
+        sparse_values = dict(values, region=region)
+        sparse_key = tuple(ax.index(sparse_values[ax.name]) for ax in histogram.sparse_axes())
+        if sparse_key not in histogram._sumw:
+            histogram._sumw[sparse_key] = np.zeros(shape=dense_shape, dtype=histogram._dtype)
+            if histogram._sumw2 is not None:
+                histogram._sumw2[sparse_key] = np.zeros(shape=dense_shape, dtype=histogram._dtype)
+        histogram._sumw[sparse_key] += sumw[i]
+        if histogram._sumw2 is not None:
+            histogram._sumw2[sparse_key] += sumw2[i]
@@ -0,0 +1,202 @@
+"""
+Compiled evaluation of jet energy corrections.
+
+The JEC text files are parsed once into binned parameter arrays, and the
+correction formulas of all levels are compiled with numba into a single kernel,
+which applies the levels one after the other in one pass over the flat jet arrays.
+
+The generated kernel source and the parameter arrays are stored in a cache
+directory, and numba caches the compiled kernel next to it. Worker processes
+therefore only parse and compile the corrections the first time they are used.
+"""
+
+import os
+import re
+import sys
+import importlib.util
+import tempfile
+
+import numpy as np
+import xxhash
+from coffea.util import awkward
+from coffea.lookup_tools.txt_converters import convert_jec_txt_file
+
+pjoin = os.path.join
+
+def jec_cache_dir():
+    """
+    Directory to store the compiled JEC kernels in. Can be set with
+    the JMECOFFTEA_JEC_CACHE environment variable.
+    """
+    return os.environ.get('JMECOFFTEA_JEC_CACHE', os.path.expanduser('~/.cache/jmecofftea/jec'))
+
+# Header of the generated kernel modules, with scalar versions of the functions used in the JEC formulas
+_KERNEL_HEADER = '''\
+# Generated by jmecofftea.helpers.jec_compiled, do not edit.
+from math import log, log10, exp, sqrt, pow, erf
+import numpy as np
+from numba import njit
+
+@njit(cache=True)
+def _find_bin(edges, value):
+    # Same as np.searchsorted(edges, value, side='right') - 1, clipped to the valid bins
+    lo = 0
+    hi = edges.shape[0]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if value < edges[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return min(max(lo - 1, 0), edges.shape[0] - 2)
+'''
+
+def _parse_level(path):
+    """
+    Parse a JEC text file into the formula and the binned parameter arrays.
+
+    :return: Tuple (formula, binning variable, bin edges, evaluation variables,
+             clamp minima, clamp maxima, parameters), the arrays have one row per bin
+    :rtype: tuple
+    """
+    (formula, (bins, bin_order), (clamp_mins, clamp_maxs, var_order), (parms, _)), = convert_jec_txt_file(path).values()
+    if len(bin_order) != 1:
+        raise NotImplementedError(f'Compiled JECs only support one binning variable, {path} has {len(bin_order)}.')
+    binvar = bin_order[0]
+    edges = np.asarray(bins[binvar], dtype=np.float64)
+    nbins = edges.size - 1
+
+    def per_bin(jagged):
+        # One value per bin, or a single value for all bins
+        content = np.asarray(jagged.content, dtype=np.float64)
+        return np.broadcast_to(content, (nbins,)) if content.size == 1 else content
+
+    clamp_min = np.stack([per_bin(clamp_mins[var]) for var in var_order], axis=1)
+    clamp_max = np.stack([per_bin(clamp_maxs[var]) for var in var_order], axis=1)
+    parameters = np.stack([per_bin(p) for p in parms], axis=1) if parms else np.zeros((nbins, 0))
+    return formula, binvar, edges, list(var_order), clamp_min, clamp_max, parameters
+
+def _kernel_source(levels):
+    """
+    Generate the source of the kernel applying the given levels.
+
+    :param levels: List of (formula, binning variable, evaluation variables) per level
+    :type levels: list
+    :return: Source code of the kernel module
+    :rtype: str
+    """
+    variables = ['JetPt']
+    for _, binvar, evalvars in levels:
+        for var in [binvar] + evalvars:
+            if var not in variables:
+                variables.append(var)
+
+    args = list(variables)
+    body = []
+    for i, (formula, binvar, evalvars) in enumerate(levels):
+        args += [f'edges_{i}', f'clamp_min_{i}', f'clamp_max_{i}', f'parms_{i}']
+        body.append(f'        b = _find_bin(edges_{i}, {binvar}[j])')
+        # Clamp the evaluation variables to the validity range of the bin
+        for k, var in enumerate(evalvars):
+            body.append(f'        {var}_{i} = min(max({var}[j], clamp_min_{i}[b, {k}]), clamp_max_{i}[b, {k}])')
+        expression = re.sub(r'\bp(\d+)\b', rf'parms_{i}[b, \1]', formula)
+        for var in evalvars:
+            expression = re.sub(rf'\b{var}\b', f'{var}_{i}', expression)
+        body.append(f'        c = {expression}')
+        # The corrected pt is the input of the next level
+        body.append( '        JetPt[j] *= c')
+        body.append( '        correction[j] *= c')
+
+    source = _KERNEL_HEADER + f'''
+SIGNATURE = {variables!r}
+
+@njit(cache=True)
+def correct({", ".join(args)}):
+    correction = np.ones(JetPt.shape[0], dtype=JetPt.dtype)
+    for j in range(JetPt.shape[0]):
+''' + '\n'.join(body) + '''
+    return correction
+'''
+    return source
+
+def _write_atomic(path, write):
+    """Write a file via a temporary file, so that concurrent workers never see a partial file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+def _load_kernel(path, name):
+    """Import the generated kernel module from the given file."""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # numba looks up the module of cached functions by name
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+class CompiledJetCorrector(object):
+    """
+    Drop-in replacement for coffea's FactorizedJetCorrector, with all levels
+    evaluated in one compiled kernel.
+
+    Like FactorizedJetCorrector, getCorrection() multiplies the content of the
+    JetPt array IN PLACE with the correction, and returns the total correction.
+
+    :param files: JEC text files of the levels to apply, in the order of application
+    :type files: list
+    :param cache_dir: Directory for the generated kernels and parameter arrays, by default jec_cache_dir()
+    :type cache_dir: str
+    """
+    def __init__(self, files, cache_dir=None):
+        cache_dir = cache_dir or jec_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Key of the cached kernel: This module (the code generator) and the JEC files
+        h = xxhash.xxh64()
+        for path in [__file__] + list(files):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        name = f'jec_kernel_{h.hexdigest()}'
+        source_path = pjoin(cache_dir, f'{name}.py')
+        arrays_path = pjoin(cache_dir, f'{name}.npz')
+
+        if os.path.exists(source_path) and os.path.exists(arrays_path):
+            with np.load(arrays_path) as arrays:
+                self._arrays = [arrays[f'arr_{i}'] for i in range(len(arrays.files))]
+        else:
+            levels = [_parse_level(path) for path in files]
+            source = _kernel_source([(formula, binvar, evalvars) for formula, binvar, _, evalvars, *_ in levels])
+            self._arrays = []
+            for _, _, edges, _, clamp_min, clamp_max, parameters in levels:
+                self._arrays += [edges, np.ascontiguousarray(clamp_min), np.ascontiguousarray(clamp_max), np.ascontiguousarray(parameters)]
+            _write_atomic(arrays_path, lambda f: np.savez(f, *self._arrays))
+            _write_atomic(source_path, lambda f: f.write(source.encode('utf-8')))
+
+        module = _load_kernel(source_path, name)
+        self._kernel = module.correct
+        self._signature = module.SIGNATURE
+
+    @property
+    def signature(self):
+        """The list of jet properties to be passed as kwargs to getCorrection()"""
+        return list(self._signature)
+
+    def getCorrection(self, **kwargs):
+        """
+        Apply the corrections to the JetPt array in place,
+        and return the total correction for all input jets.
+        """
+        offsets = None
+        args = []
+        for var in self._signature:
+            value = kwargs[var]
+            if isinstance(value, awkward.JaggedArray):
+                offsets = value.offsets
+                value = value.content
+            # JetPt is corrected in place, the other inputs may be virtual arrays
+            args.append(value if var == 'JetPt' else np.asarray(value))
+        correction = self._kernel(*args, *self._arrays)
+        if offsets is not None:
+            return awkward.JaggedArray.fromoffsets(offsets, correction)
+        return correction
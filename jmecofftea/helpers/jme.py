@@ -1,22 +1,90 @@
 import numpy as np
+import xxhash
+import awkward
 
 from coffea.lookup_tools import extractor
-from coffea.jetmet_tools import FactorizedJetCorrector
+from coffea.lookup_tools.txt_converters import convert_junc_txt_file
+from coffea.lookup_tools.jec_uncertainty_lookup import jec_uncertainty_lookup
+from coffea.jetmet_tools import FactorizedJetCorrector, JetCorrectionUncertainty
 
 from jmecofftea.helpers.paths import jmecofftea_path
+from jmecofftea.helpers.jec_compiled import CompiledJetCorrector
 
-def get_jme_correctors(jecs_tag):
+# JEC levels that are read from the text files for a given JEC tag
+JEC_LEVELS = [
+    'L1FastJet',
+    'L2Relative',
+    'L2Residual',
+    'L3Absolute',
+    'L2L3Residual',
+]
+
+# Process-level cache of the JEC correctors, so that the text files are
+# parsed only once per worker process, instead of once for every chunk.
+# Maps (JEC tag, content hash of the input files) -> correctors
+_CORRECTOR_CACHE = {}
+_CORRECTOR_CACHE_STATS = {'hits' : 0, 'misses' : 0}
+
+# Same for the JES uncertainties, maps (JEC tag, content hash of the file) -> uncertainty
+_UNCERTAINTY_CACHE = {}
+
+def jec_files(jecs_tag, levels=JEC_LEVELS):
+    """
+    Returns the list of JEC text files for the given JEC tag.
+    """
+    return [jmecofftea_path(f'data/jme/{jecs_tag}_{level}_AK4PFPuppi.txt') for level in levels]
+
+def _hash_files(paths):
+    """Returns a hash of the contents of the given files."""
+    h = xxhash.xxh64()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def jec_cache_info():
+    """
+    Returns the number of hits and misses of the JEC corrector cache in this process.
+    """
+    return dict(_CORRECTOR_CACHE_STATS)
+
+def get_jme_correctors(jecs_tag, compiled=False):
+    """
+    Get jet corrector object having L1L2L3 corrections for the given JEC tag.
+
+    The correctors are cached per process, keyed by the JEC tag and the
+    content hash of the JEC text files.
+
+    If compiled=True, the corrections are evaluated with numba-compiled kernels
+    (see jmecofftea.helpers.jec_compiled), which give identical results.
+    """
+    key = (jecs_tag, _hash_files(jec_files(jecs_tag)), compiled)
+    if key in _CORRECTOR_CACHE:
+        _CORRECTOR_CACHE_STATS['hits'] += 1
+        return _CORRECTOR_CACHE[key]
+
+    _CORRECTOR_CACHE_STATS['misses'] += 1
+    if compiled:
+        _CORRECTOR_CACHE[key] = _build_compiled_jme_correctors(jecs_tag)
+    else:
+        _CORRECTOR_CACHE[key] = _build_jme_correctors(jecs_tag)
+    return _CORRECTOR_CACHE[key]
+
+def _build_compiled_jme_correctors(jecs_tag):
+    """
+    Build compiled jet correctors for the given JEC tag, with the same levels as _build_jme_correctors().
+    """
+    correctors = {}
+    correctors["L1L2L3"] = CompiledJetCorrector(jec_files(jecs_tag, levels=['L1FastJet', 'L2Relative', 'L3Absolute']))
+    correctors["L2L3Res"] = CompiledJetCorrector(jec_files(jecs_tag, levels=['L2L3Residual']))
+    return correctors
+
+def _build_jme_correctors(jecs_tag):
     """
-    Get jet corrector object having L1L2L3 corrections for the given JEC tag. 
+    Build the jet corrector objects for the given JEC tag from the text files.
     """
     ext = extractor()
-    ext.add_weight_sets([
-        f"* * {jmecofftea_path(f'data/jme/{jecs_tag}_L1FastJet_AK4PFPuppi.txt')}",
-        f"* * {jmecofftea_path(f'data/jme/{jecs_tag}_L2Relative_AK4PFPuppi.txt')}",
-        f"* * {jmecofftea_path(f'data/jme/{jecs_tag}_L2Residual_AK4PFPuppi.txt')}",
-        f"* * {jmecofftea_path(f'data/jme/{jecs_tag}_L3Absolute_AK4PFPuppi.txt')}",
-        f"* * {jmecofftea_path(f'data/jme/{jecs_tag}_L2L3Residual_AK4PFPuppi.txt')}",
-    ])
+    ext.add_weight_sets([f"* * {path}" for path in jec_files(jecs_tag)])
     ext.finalize()
     
     evaluator = ext.make_evaluator()
@@ -38,6 +106,115 @@ def get_jme_correctors(jecs_tag):
     return correctors
 
 
+def get_jes_uncertainty(jecs_tag):
+    """
+    Get the JES uncertainty object for the given JEC tag, cached per process like the correctors.
+    """
+    path, = jec_files(jecs_tag, levels=['Uncertainty'])
+    key = (jecs_tag, _hash_files([path]))
+    if key not in _UNCERTAINTY_CACHE:
+        lookups = {
+            name : jec_uncertainty_lookup(*args)
+            for (name, _), args in convert_junc_txt_file(path).items()
+        }
+        _UNCERTAINTY_CACHE[key] = JetCorrectionUncertainty(**lookups)
+    return _UNCERTAINTY_CACHE[key]
+
+def jes_variations(uncertainties, era_masks, jet_pt, jet_eta):
+    """
+    Compute the jet pt for the up and down JES variations.
+
+    :param uncertainties: Mapping JEC tag -> uncertainty object, as returned by get_jes_uncertainty()
+    :type uncertainties: dict
+    :param era_masks: Mapping JEC tag -> event mask, as returned by jec_era_masks()
+    :type era_masks: dict
+    :param jet_pt: Corrected jet pt
+    :type jet_pt: JaggedArray
+    :param jet_eta: Jet eta
+    :type jet_eta: JaggedArray
+    :return: Mapping variation name (e.g. "jesUp") -> varied jet pt
+    :rtype: dict
+    """
+    counts = jet_pt.counts
+    pt = jet_pt.content
+
+    # Up and down factors per uncertainty source, as flat arrays of shape (number of jets, 2)
+    factors = {}
+    for tag, mask in era_masks.items():
+        if len(era_masks) == 1:
+            for source, factor in uncertainties[tag].getUncertainty(JetEta=jet_eta, JetPt=jet_pt):
+                factors[source] = factor.content
+            continue
+        jet_mask = np.repeat(mask, counts)
+        for source, factor in uncertainties[tag].getUncertainty(JetEta=np.asarray(jet_eta.content)[jet_mask], JetPt=pt[jet_mask]):
+            factors.setdefault(source, np.ones((pt.size, 2)))[jet_mask] = factor
+
+    variations = {}
+    for source, factor in factors.items():
+        name = source if source.startswith('jes') else f'jes{source}'
+        for i, direction in enumerate(['Up', 'Down']):
+            varied = (pt * factor[:, i]).astype(pt.dtype)
+            variations[f'{name}{direction}'] = awkward.JaggedArray.fromcounts(counts, varied)
+    return variations
+
+def jec_era_masks(runs, default_tag, eras):
+    """
+    Assign the events to JEC tags based on their run number.
+
+    :param runs: Run number per event
+    :type runs: numpy.ndarray
+    :param default_tag: JEC tag for events outside of all run ranges
+    :type default_tag: str
+    :param eras: Run-dependent JEC tags, each a mapping with the keys "tag" and "runs" = [run_min, run_max].
+                 If the run ranges overlap, the first matching one is used.
+    :type eras: list
+    :return: Mapping JEC tag -> event mask, only for tags with at least one event
+    :rtype: dict
+    """
+    masks = {}
+    remaining = np.ones(len(runs), dtype=bool)
+    for era in eras:
+        run_min, run_max = era['runs']
+        mask = remaining & (runs >= run_min) & (runs <= run_max)
+        if mask.any():
+            masks[era['tag']] = masks[era['tag']] | mask if era['tag'] in masks else mask
+            remaining &= ~mask
+    if remaining.any():
+        masks[default_tag] = masks[default_tag] | remaining if default_tag in masks else remaining
+    return masks
+
+def apply_jecs(correctors, level, era_masks, **jets):
+    """
+    Apply one level of JECs, with the correctors of the JEC tag of each event.
+
+    Like FactorizedJetCorrector.getCorrection(), this changes the content of
+    the JetPt array IN PLACE. If all events belong to one tag, the corrector is
+    applied to the full arrays, otherwise to the jets of each tag in turn.
+
+    :param correctors: Mapping JEC tag -> correctors, as returned by get_jme_correctors()
+    :type correctors: dict
+    :param level: Name of the corrector to apply, e.g. "L1L2L3"
+    :type level: str
+    :param era_masks: Mapping JEC tag -> event mask, as returned by jec_era_masks()
+    :type era_masks: dict
+    :param jets: Jet properties needed by the corrector (JetPt, JetEta, ...), as jagged arrays
+    """
+    if len(era_masks) == 1:
+        tag, = era_masks
+        correctors[tag][level].getCorrection(**jets)
+        return
+
+    counts = jets['JetPt'].counts
+    pt = jets['JetPt'].content
+    for tag, mask in era_masks.items():
+        jet_mask = np.repeat(mask, counts)
+        selected = {
+            name : awkward.JaggedArray.fromcounts(counts[mask], np.asarray(value.content)[jet_mask])
+            for name, value in jets.items()
+        }
+        correctors[tag][level].getCorrection(**selected)
+        pt[jet_mask] = selected['JetPt'].content
+
 def propagate_jecs_to_met(met_pt_orig, met_phi_orig, ak4_init_p4, ak4_corrected_p4):
     """
     Apply type-1 correction on MET using the corrected AK4 jets.
@@ -54,4 +231,47 @@ def propagate_jecs_to_met(met_pt_orig, met_phi_orig, ak4_init_p4, ak4_corrected_
     met_pt_corrected = np.hypot(met_px_corrected, met_py_corrected)
     met_phi_corrected = np.arctan2(met_py_corrected, met_px_corrected)
 
-    return met_pt_corrected, met_phi_corrected
\ No newline at end of file
+    return met_pt_corrected, met_phi_corrected
+
+def propagate_jec_shifts_to_met(met_pt_orig, met_phi_orig, jet_pt_orig, jet_pt_corrected, jet_phi):
+    """
+    Apply type-1 correction on MET, given the AK4 jet pt before and after the correction.
+
+    Gives the same result as propagate_jecs_to_met(), but only needs the flat
+    jet pt content from before the correction, instead of a copy of the jet 4-vectors.
+
+    :param met_pt_orig: Uncorrected MET pt per event
+    :type met_pt_orig: numpy.ndarray
+    :param met_phi_orig: Uncorrected MET phi per event
+    :type met_phi_orig: numpy.ndarray
+    :param jet_pt_orig: Flat jet pt before the correction
+    :type jet_pt_orig: numpy.ndarray
+    :param jet_pt_corrected: Jet pt after the correction
+    :type jet_pt_corrected: JaggedArray
+    :param jet_phi: Jet phi
+    :type jet_phi: JaggedArray
+    :return: Corrected MET pt and phi per event
+    :rtype: tuple
+    """
+    # Compute uncorrected x and y components of MET
+    met_px_orig = met_pt_orig * np.cos(met_phi_orig)
+    met_py_orig = met_pt_orig * np.sin(met_phi_orig)
+
+    # Shifts of the jet x and y components, as flat arrays
+    phi = jet_phi.flatten()
+    pt_corrected = jet_pt_corrected.flatten()
+    cos_phi = np.cos(phi)
+    sin_phi = np.sin(phi)
+    dpx = jet_pt_orig * cos_phi - pt_corrected * cos_phi
+    dpy = jet_pt_orig * sin_phi - pt_corrected * sin_phi
+
+    # Per-event sums of the shifts (segment reduction over the jets of each event)
+    counts = jet_phi.counts
+    met_px_corrected = met_px_orig - awkward.JaggedArray.fromcounts(counts, dpx).sum()
+    met_py_corrected = met_py_orig - awkward.JaggedArray.fromcounts(counts, dpy).sum()
+
+    # Get the corrected MET pt and MET phi
+    met_pt_corrected = np.hypot(met_px_corrected, met_py_corrected)
+    met_phi_corrected = np.arctan2(met_py_corrected, met_px_corrected)
+
+    return met_pt_corrected, met_phi_corrected
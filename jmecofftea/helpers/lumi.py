@@ -0,0 +1,121 @@
+import os
+import json
+
+import numpy as np
+import xxhash
+
+# Per-process cache of the compiled lumi masks:
+# Path to golden JSON -> LumiMaskIndex object
+_LUMI_MASK_CACHE = {}
+
+def _pack(runs, lumis):
+    """Pack run and lumi numbers into a single 64-bit key: (run << 32) | lumi"""
+    return (np.asarray(runs).astype(np.uint64) << np.uint64(32)) | np.asarray(lumis).astype(np.uint64)
+
+def _hash_file(path):
+    """Returns a hash of the contents of the given file."""
+    with open(path, 'rb') as f:
+        return xxhash.xxh64(f.read()).hexdigest()
+
+def index_path(json_path):
+    """Path of the compiled .npz index, stored next to the golden JSON file."""
+    return os.path.splitext(json_path)[0] + '.npz'
+
+class LumiMaskIndex(object):
+    """
+    Compiled version of a golden JSON file, to be used instead of coffea's LumiMask.
+
+    The certified lumi ranges are stored as two sorted arrays of packed
+    (run, lumi) keys holding the first and the last lumi section of each range.
+    The mask is then evaluated with a single searchsorted call over the packed
+    (run, lumi) keys of the events.
+    """
+    def __init__(self, starts, stops, source_hash=''):
+        self._starts = starts
+        self._stops = stops
+        self.source_hash = source_hash
+
+    @classmethod
+    def from_json(cls, json_path):
+        """Compile the index from a golden JSON file."""
+        with open(json_path) as f:
+            lumis = json.load(f)
+
+        ranges = []
+        for run, lumi_ranges in lumis.items():
+            for lumi_start, lumi_stop in lumi_ranges:
+                ranges.append((int(run), lumi_start, lumi_stop))
+        ranges.sort()
+
+        # Merge overlapping ranges so that the start keys are unique and ordered
+        merged = []
+        for run, lumi_start, lumi_stop in ranges:
+            if merged and merged[-1][0] == run and lumi_start <= merged[-1][2] + 1:
+                merged[-1][2] = max(merged[-1][2], lumi_stop)
+            else:
+                merged.append([run, lumi_start, lumi_stop])
+
+        merged = np.array(merged, dtype=np.uint64).reshape(-1, 3)
+        starts = _pack(merged[:, 0], merged[:, 1])
+        stops = _pack(merged[:, 0], merged[:, 2])
+
+        return cls(starts, stops, source_hash=_hash_file(json_path))
+
+    @classmethod
+    def from_npz(cls, npz_path):
+        """Load a previously compiled index."""
+        with np.load(npz_path) as f:
+            return cls(f['starts'], f['stops'], source_hash=str(f['source_hash']))
+
+    def to_npz(self, npz_path):
+        """
+        Save the compiled index. The file is written to a temporary location
+        first and then moved, so that concurrent workers never see a partial file.
+        """
+        tmp_path = f'{npz_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, starts=self._starts, stops=self._stops, source_hash=self.source_hash)
+        os.replace(tmp_path, npz_path)
+
+    def __call__(self, runs, lumis):
+        """
+        Returns a boolean mask, True for events in certified lumi sections.
+        """
+        keys = _pack(runs, lumis)
+        if not len(self._starts):
+            return np.zeros(len(keys), dtype=bool)
+        # Index of the last range starting at or before each key
+        idx = np.searchsorted(self._starts, keys, side='right') - 1
+        return (idx >= 0) & (keys <= self._stops[np.maximum(idx, 0)])
+
+def get_lumi_mask(json_path):
+    """
+    Returns the compiled lumi mask for the given golden JSON file.
+
+    The mask is loaded once per process. The compiled .npz index next to
+    the JSON file is used if it is up to date with the JSON content,
+    otherwise it is (re)compiled and saved, if the location is writable.
+    """
+    if json_path in _LUMI_MASK_CACHE:
+        return _LUMI_MASK_CACHE[json_path]
+
+    npz_path = index_path(json_path)
+    mask = None
+    if os.path.exists(npz_path):
+        try:
+            mask = LumiMaskIndex.from_npz(npz_path)
+        except (OSError, ValueError, KeyError):
+            mask = None
+        if mask is not None and mask.source_hash != _hash_file(json_path):
+            mask = None
+
+    if mask is None:
+        mask = LumiMaskIndex.from_json(json_path)
+        try:
+            mask.to_npz(npz_path)
+        except OSError:
+            # Read-only location, just keep the index in memory
+            pass
+
+    _LUMI_MASK_CACHE[json_path] = mask
+    return mask
@@ -1,74 +1,134 @@
 #!/usr/bin/env python
 import itertools
-import time
 import os
+import json
+import io
+import xxhash
+import cloudpickle
+import lz4.frame
 from tqdm import tqdm
-from coffea.util import load
 from klepto.archives import dir_archive
 
 pjoin = os.path.join
 import cachetools.func
 import multiprocessing
-def _load_keys(fn):
-    '''Returns the keys saved in a coffea file'''
-    return list(map(str, load(fn).keys()))
 
-def _load_acc(args):
-    '''Returns the accumulator saved in a coffea file'''
-    fn, key = args
-    return load(fn)[key]
+# Name of the manifest file in the klepto directory, keeping track of the merged input files
+MANIFEST_NAME = 'jmerge_manifest.json'
 
-def _load_and_sum(args):
-    """
-    merge item from list of coffea files and dump it to file
+def _file_info(fn, content=None):
+    '''
+    Returns the size, modification time and content hash of a file,
+    which are used to recognize changed inputs. If the content of the
+    file has already been read, it is hashed instead of reading the file again.
+    '''
+    stat = os.stat(fn)
+    if content is None:
+        with open(fn, 'rb') as f:
+            content = f.read()
+    return {
+        'size' : stat.st_size,
+        'mtime' : stat.st_mtime,
+        'hash' : xxhash.xxh64(content).hexdigest(),
+    }
+
+def _load_with_info(fn):
+    '''
+    Load a coffea file like coffea.util.load, and return it together with its file info.
+    The file is read only once, for both the hash and the content.
+    '''
+    with open(fn, 'rb') as f:
+        content = f.read()
+    info = _file_info(fn, content)
+    with lz4.frame.open(io.BytesIO(content)) as fin:
+        output = cloudpickle.load(fin)
+    return output, info
 
-    For each file, the saved item corresponding to the
-    same key is read out. The sum of the individual
-    items for the individual files is dumped.
+def _check_unchanged(fn, info):
+    '''
+    Checks whether the file is unchanged with respect to the saved file info.
 
-    :param args: Tuple (key to use, file list, output name)
-    :type args: tuple
-    :return: 0
-    :rtype: int
+    :return: The file info, with an updated modification time if only the
+             modification time changed, or None if the file changed or was removed
+    :rtype: dict
+    '''
+    try:
+        stat = os.stat(fn)
+    except FileNotFoundError:
+        return None
+    if stat.st_size != info['size']:
+        return None
+    if stat.st_mtime == info['mtime']:
+        return info
+    # Only the modification time changed, compare the content
+    current = _file_info(fn)
+    if current['hash'] != info['hash']:
+        return None
+    return current
+
+def _split_into_groups(items, ngroups):
+    '''Split list of items into ngroups ~equal sized groups'''
+    groups = [items[i::ngroups] for i in range(ngroups)]
+    return [g for g in groups if len(g)]
+
+def _add_to(sums, key, item):
+    '''Add item to the partial sum for the given key'''
+    if key in sums:
+        sums[key] += item
+    else:
+        sums[key] = item
+
+def _load_and_sum_files(args):
     """
+    Load each file in a group of coffea files exactly once
+    and sum up the saved items per key.
 
-    # Args is a tuple for easy multiprocessing
-    key, files, outname = args
+    :param args: Tuple (file list, whether to keep the tree items)
+    :type args: tuple
+    :return: Tuple (dictionary key -> partial sum, dictionary file -> file info)
+    :rtype: tuple
+    """
+    files, save_trees = args
 
-    # Load the individual items
-    items = []
+    sums = {}
+    infos = {}
     for fn in files:
-        try:
-            items.append(load(fn)[key])
-        except KeyError:
-            continue
-    
-    # Recursive merging
-    while len(items) > 1:
-        x = items.pop(0)
-        y = items.pop(0)
-        s = x + y
-        items.append(s)
-    
-    assert(len(items)==1)
-    
-    # dump the content using klepto
-    arc = dir_archive(
-                    outname,
-                    serialized=True,
-                    compression=0,
-                    memsize=1e3,
-                    )
-    arc[key] = items[0]
-    arc.dump(key)
-    arc.clear()
-    return 0
+        output, infos[fn] = _load_with_info(fn)
+
+        for key, item in output.items():
+            key = str(key)
+            if not save_trees and key.startswith("tree"):
+                continue
+            _add_to(sums, key, item)
+    return sums, infos
+
+def _add_partial_sums(args):
+    """
+    Add up two dictionaries of partial sums, key by key.
+
+    :param args: Tuple of two dictionaries key -> partial sum
+    :type args: tuple
+    :return: Dictionary key -> sum
+    :rtype: dict
+    """
+    sums, other = args
+    for key, item in other.items():
+        _add_to(sums, key, item)
+    return sums
 
 class CoffeaMerger(object):
     '''
     Handles the merging of large numbers of coffea files.
+
+    Each input file is read exactly once: The files are split into groups,
+    every worker sums up the items of one group per key, and the partial sums
+    are then added pairwise in the worker pool (reduction tree).
     
-    The results are stored using the klepto library.
+    The results are stored using the klepto library. A manifest of the merged
+    input files is saved in the output directory. When merging into an existing
+    output directory, only new input files are merged and added to the stored sums.
+    If an input that was already merged has changed or was removed, the full
+    merge is recomputed instead.
     '''
     def __init__(self, indir, jobs=1, save_trees=False):
         files = filter(lambda x: x.endswith(".coffea") and not ('cache' in x), os.listdir(indir))
@@ -76,48 +136,126 @@ class CoffeaMerger(object):
         self._files = files
         self._keys = set()
         self._save_trees = save_trees
+        self._jobs = jobs
 
         # Open a multiproc pool for various operations
         self._pool = multiprocessing.Pool(processes=jobs)
-        self._init_keys()
 
-    def _init_keys(self):
+    def _merge(self, files):
+        '''
+        Merge the given files and return a tuple of
+        dictionaries (key -> sum, file -> file info).
+        '''
+        if not len(files):
+            return {}, {}
+
+        # A few groups per worker, to balance the load between workers
+        groups = _split_into_groups(files, min(len(files), 4 * self._jobs))
+
+        partial_sums = []
+        file_infos = {}
+        t = tqdm(total=len(files), desc='Merging inputs', unit='file')
+        args = [(group, self._save_trees) for group in groups]
+        for sums, infos in self._pool.imap_unordered(_load_and_sum_files, args):
+            partial_sums.append(sums)
+            file_infos.update(infos)
+            t.update(len(infos))
+        t.close()
+
+        # Reduction tree: Add the partial sums pairwise until only one is left
+        while len(partial_sums) > 1:
+            pairs = list(zip(partial_sums[0::2], partial_sums[1::2]))
+            leftover = partial_sums[-1:] if len(partial_sums) % 2 else []
+            partial_sums = self._pool.map(_add_partial_sums, pairs) + leftover
+
+        return partial_sums[0], file_infos
+
+    def _load_manifest(self, outname):
         '''
-        Construct set of all keys.
+        Returns the manifest of the existing output directory,
+        or None if there is no (usable) manifest.
         '''
-        pool_result = self._pool.map_async(
-            _load_keys,
-            self._files
-        )
-        for keys in pool_result.get():
-            for k in keys:
-                if not self._save_trees and k.startswith("tree"):
-                    continue
-                self._keys.add(str(k))
-
-    def to_klepto_dir(self, outname):
+        try:
+            with open(pjoin(outname, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('save_trees') != self._save_trees:
+            return None
+        return manifest
+
+    def _save_manifest(self, outname, files):
+        '''Atomically write the manifest of merged files.'''
+        manifest = {
+            'save_trees' : self._save_trees,
+            'files' : files,
+        }
+        path = pjoin(outname, MANIFEST_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def to_klepto_dir(self, outname, full=False):
         '''
         Run the merging and save to a klepto dir.
+
+        If the output directory already holds a merge of a subset of the inputs,
+        only the new input files are merged on top of it, unless full=True.
         '''
+        merged_files = {}
+        manifest = None if full else self._load_manifest(outname)
+        if manifest is not None:
+            checked = {fn : _check_unchanged(fn, info) for fn, info in manifest['files'].items()}
+            changed = [fn for fn, info in checked.items() if info is None]
+            if changed:
+                print(f'{len(changed)} of the already merged input files changed or were removed, will recompute the full merge.')
+                manifest = None
+            else:
+                merged_files = checked
+
+        files = [fn for fn in self._files if fn not in merged_files]
+        if manifest is not None:
+            print(f'Found {len(merged_files)} already merged input files, will merge {len(files)} new files.')
+            if not files:
+                # Store the modification times of files which were only touched,
+                # so that they are not hashed again on the next run
+                if merged_files != manifest['files']:
+                    self._save_manifest(outname, merged_files)
+                self._keys = set()
+                return
+
+        sums, file_infos = self._merge(files)
+        self._keys = set(sums.keys())
+
+        # Save each key to file
+        arc = dir_archive(
+                        outname,
+                        serialized=True,
+                        compression=0,
+                        memsize=1e3,
+                        )
+        # Invalidate the manifest while the archive is being modified
+        if os.path.exists(pjoin(outname, MANIFEST_NAME)):
+            os.remove(pjoin(outname, MANIFEST_NAME))
+
+        if manifest is None:
+            # Full recompute: Remove all stored keys, so that keys which are
+            # not part of the new merge do not survive from an earlier one
+            arc.archive.clear()
+            existing_keys = set()
+        else:
+            existing_keys = set(arc.archive.keys())
+        for key in tqdm(sorted(self._keys), desc='Saving'):
+            item = sums.pop(key)
+            # Incremental merge: add on top of the stored sum
+            if key in existing_keys:
+                arc.load(key)
+                stored = arc[key]
+                stored += item
+                item = stored
+            arc[key] = item
+            arc.dump(key)
+            arc.clear()
 
-        # Queue asynchronous jobs for each key
-        results = []
-        for key in self._keys:
-            # Each job loads and merges
-            # the items for a specific key
-            # from all files
-            args = [(key, self._files, outname)]
-            result = self._pool.map_async(
-                    _load_and_sum,
-                    args
-                    )
-            results.append(result)
-        
-        # Waiting for results and saving to file
-        t = tqdm(total=len(self._keys), desc='Merging inputs')
-        while len(results):
-            for res in reversed(results):
-                if res.ready():
-                    results.remove(res)
-                    t.update()
-            time.sleep(1)
+        merged_files.update(file_infos)
+        self._save_manifest(outname, merged_files)
@@ -0,0 +1,77 @@
+"""Lightweight timing of the processing stages within a processor"""
+
+import time
+from contextlib import contextmanager
+
+import tabulate
+
+# Stage timings of the chunk that is currently being processed, None if nothing is recorded
+_ACTIVE_TIMINGS = None
+# Names of the stages which are currently entered, outermost first
+_ACTIVE_STAGES = []
+
+# Separator between the names of a stage and the stages nested in it
+STAGE_SEPARATOR = '/'
+
+@contextmanager
+def record_stages():
+    """
+    Record the timings of all stages entered while this context is active.
+    Yields a dictionary stage name -> time in seconds, which is filled in place.
+    """
+    global _ACTIVE_TIMINGS, _ACTIVE_STAGES
+    previous = _ACTIVE_TIMINGS, _ACTIVE_STAGES
+    timings = {}
+    _ACTIVE_TIMINGS, _ACTIVE_STAGES = timings, []
+    try:
+        yield timings
+    finally:
+        _ACTIVE_TIMINGS, _ACTIVE_STAGES = previous
+
+@contextmanager
+def stage(name):
+    """
+    Time the enclosed block as the given processing stage. Entering the same
+    stage several times adds up the timings. Stages nested in another stage are
+    recorded under a hierarchical name, e.g. "region loop/histogram fills",
+    and their time is also part of the time of the enclosing stage.
+    If no recording is active, this does nothing, so processors can use it unconditionally.
+    """
+    timings = _ACTIVE_TIMINGS
+    if timings is None:
+        yield
+        return
+    _ACTIVE_STAGES.append(name)
+    key = STAGE_SEPARATOR.join(_ACTIVE_STAGES)
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[key] = timings.get(key, 0.) + time.perf_counter() - tic
+        _ACTIVE_STAGES.pop()
+
+def print_stages(stages, processtime=None):
+    """
+    Pretty-print the accumulated stage timings to the terminal.
+    Nested stages are listed below their enclosing stage. The fraction of the
+    process time is only given for the top-level stages, which do not overlap.
+    """
+    if not stages:
+        return
+    headers = ["Stage", "Time (s)"]
+    if processtime:
+        headers.append("Fraction of process time")
+
+    def sort_key(name):
+        # Slowest stages first, nested stages right after their parent
+        parts = name.split(STAGE_SEPARATOR)
+        return [(-stages.get(STAGE_SEPARATOR.join(parts[:i+1]), 0.), parts[i]) for i in range(len(parts))]
+
+    table = []
+    for name in sorted(stages, key=sort_key):
+        depth = name.count(STAGE_SEPARATOR)
+        row = [name, stages[name]]
+        if processtime:
+            row.append(stages[name] / processtime if depth == 0 else None)
+        table.append(row)
+    print(tabulate.tabulate(table, headers=headers, floatfmt=".3f", missingval=""))
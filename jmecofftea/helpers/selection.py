@@ -0,0 +1,177 @@
+import numpy as np
+
+class RegionSelection(object):
+    """
+    Stores named boolean masks (cuts) and evaluates the conjunctions of
+    cuts that define the analysis regions.
+
+    Drop-in replacement for coffea's PackedSelection, for the add() and all()
+    methods. Every mask is stored as its own boolean array, so there is no
+    limit on the number of cuts (PackedSelection is limited to 64).
+
+    The regions mostly share the same leading cuts (e.g. the common cuts,
+    followed by one or two region-specific ones). The AND of every prefix of
+    a cut list is therefore memoized: The prefixes of all evaluated regions
+    form a tree, and each intermediate AND is computed only once per chunk.
+
+    Cuts can be registered as functions, which are only evaluated once a
+    region that uses them is evaluated.
+
+    For systematic variations, varied() returns a selection in which only
+    some of the cuts are replaced, sharing all other masks with this one.
+    """
+    def __init__(self):
+        self._masks = {}
+        # Cuts which are evaluated on first use
+        self._deferred = {}
+        self._size = None
+        # Cache of the AND of cut sequences, keyed by tuple of cut names
+        self._conjunctions = {}
+        # Selection providing the cuts which are not defined in this one
+        self._parent = None
+
+    @property
+    def names(self):
+        """Current list of mask names available"""
+        names = list(self._masks.keys()) + list(self._deferred.keys())
+        if self._parent is not None:
+            names += [name for name in self._parent.names if name not in names]
+        return names
+
+    def _owns(self, name):
+        return name in self._masks or name in self._deferred
+
+    def varied(self, cuts):
+        """
+        Returns a selection in which the given cuts are replaced, e.g. by
+        their values for a systematic variation.
+
+        All other cuts are taken from this selection. The ANDs of those are
+        computed (and cached) by this selection as well, so that they are
+        shared between the nominal selection and all variations.
+
+        :param cuts: Mapping cut name -> mask, or function returning the mask
+        :type cuts: dict
+        :return: Selection with the varied cuts
+        :rtype: RegionSelection
+        """
+        varied = RegionSelection()
+        varied._parent = self
+        varied._size = self._size
+        for name, selection in cuts.items():
+            if name not in self.names:
+                raise ValueError(f"Cannot vary selection '{name}', which does not exist.")
+            varied.add(name, selection)
+        return varied
+
+    def add(self, name, selection):
+        """
+        Add a named mask.
+
+        The mask can also be given as a function without arguments, which returns
+        the mask. It is then only called if a region using this cut is evaluated,
+        so that neither the computation nor the reading of its inputs
+        happens for cuts that are not needed.
+
+        :param name: Name of the mask
+        :type name: str
+        :param selection: Flat array of dtype bool, with the same shape as the previously
+                          added masks, or a function returning such an array
+        :type selection: numpy.ndarray or callable
+        """
+        if self._owns(name):
+            raise ValueError(f"Selection '{name}' already exists.")
+        if callable(selection):
+            self._deferred[name] = selection
+        else:
+            self._store(name, selection)
+
+    def _store(self, name, selection):
+        if not (isinstance(selection, np.ndarray) and selection.dtype == np.dtype('bool')):
+            raise ValueError(f"RegionSelection only understands numpy boolean arrays, got {selection!r} for '{name}'")
+        if self._size is None:
+            self._size = selection.shape
+        elif selection.shape != self._size:
+            raise ValueError(f"New selection '{name}' has different shape than existing ones ({selection.shape} vs. {self._size})")
+        self._masks[name] = selection
+
+    def mask(self, name):
+        """Returns the mask with the given name, evaluating it if it was deferred."""
+        if self._parent is not None and not self._owns(name):
+            return self._parent.mask(name)
+        if name not in self._masks:
+            self._store(name, self._deferred.pop(name)())
+        return self._masks[name]
+
+    def all(self, *names):
+        """
+        Returns the AND of the given masks.
+
+        The result for every leading subsequence of names is cached,
+        so repeated and overlapping calls only compute the missing ANDs.
+        The returned arrays must not be modified in place.
+        """
+        if not names:
+            return np.ones(self._size, dtype=bool)
+
+        names = tuple(names)
+        if self._parent is not None:
+            # The AND is independent of the order: Evaluate the shared cuts first,
+            # with the cached ANDs of the parent, followed by the varied cuts
+            shared = tuple(name for name in names if not self._owns(name))
+            if len(shared) == len(names):
+                return self._parent.all(*shared)
+            names = shared + tuple(name for name in names if self._owns(name))
+            if shared and shared not in self._conjunctions:
+                self._conjunctions[shared] = self._parent.all(*shared)
+
+        # Find the longest already computed prefix
+        n = len(names)
+        while n > 0 and names[:n] not in self._conjunctions:
+            n -= 1
+
+        if n == 0:
+            mask = self.mask(names[0])
+            self._conjunctions[names[:1]] = mask
+            n = 1
+        else:
+            mask = self._conjunctions[names[:n]]
+
+        # Extend the prefix one cut at a time, caching every step
+        for i in range(n, len(names)):
+            mask = mask & self.mask(names[i])
+            self._conjunctions[names[:i + 1]] = mask
+
+        return mask
+
+def efficiency_regions(regions):
+    """
+    Combine pairs of numerator and denominator regions for efficiency histograms.
+
+    A region "X_den" and its counterpart "X_num" are combined into one region "X",
+    if the numerator cuts are the denominator cuts plus additional (trigger) cuts.
+    Regions without such a counterpart are kept as they are.
+
+    :param regions: Mapping region name -> list of cuts
+    :type regions: dict
+    :return: Mapping region name -> (cuts of the region, cuts for passing events or None)
+    :rtype: dict
+    """
+    combined = {}
+    paired = set()
+    for region, cuts in regions.items():
+        if '_den' not in region:
+            continue
+        num_region = region.replace('_den', '_num', 1)
+        num_cuts = regions.get(num_region)
+        if num_cuts is None or not set(cuts) <= set(num_cuts):
+            continue
+        # Order the cuts as denominator + additional cuts, to reuse the denominator mask
+        extra_cuts = [cut for cut in num_cuts if cut not in cuts]
+        combined[region.replace('_den', '', 1)] = (cuts, cuts + extra_cuts)
+        paired.update([region, num_region])
+
+    for region, cuts in regions.items():
+        if region not in paired:
+            combined[region] = (cuts, None)
+    return combined
@@ -7,18 +7,73 @@ import numpy as np
 from coffea import hist
 from coffea.analysis_objects import JaggedCandidateArray, JaggedTLorentzVectorArray
 
+from jmecofftea.helpers import lazy_branch
+
 Hist = hist.Hist
 Bin = hist.Bin
 Cat = hist.Cat
 
-def hlt_accumulator():
+# L1 seeds of the HLT_PFHT1050 path
+L1_SEEDS_HT1050 = [
+    'L1_HTT120er',
+    'L1_HTT160er',
+    'L1_HTT200er',
+    'L1_HTT255er',
+    'L1_HTT280er',
+    'L1_HTT280er_QuadJet_70_55_40_35_er2p5',
+    'L1_HTT320er_QuadJet_80_60_er2p1_45_40_er2p3',
+    'L1_HTT320er_QuadJet_80_60_er2p1_50_45_er2p3',
+    'L1_HTT320er',
+    'L1_HTT360er',
+    'L1_ETT2000',
+    'L1_HTT400er',
+    'L1_HTT450er',
+]
+
+# Trigger cuts -> Name of the HLT path
+HLT_TRIGGER_CUTS = {
+    # MET triggers
+    'HLT_PFMET120' : 'HLT_PFMET120_PFMHT120_IDTight',
+    'HLT_PFMETNoMu120' : 'HLT_PFMETNoMu120_PFMHTNoMu120_IDTight',
+    # Jet500 + HT1050 triggers
+    'HLT_PFJet500' : 'HLT_PFJet500',
+    'HLT_PFHT1050' : 'HLT_PFHT1050',
+    # Single Muon trigger
+    'HLT_IsoMu27' : 'HLT_IsoMu27',
+}
+
+# HF-filtered METNoMu triggers - available starting from 2022 data taking
+HLT_FILTERHF_TRIGGER_CUTS = {
+    'HLT_PFMETNoMu110_FilterHF' : 'HLT_PFMETNoMu110_PFMHTNoMu110_IDTight_FilterHF',
+    'HLT_PFMETNoMu120_FilterHF' : 'HLT_PFMETNoMu120_PFMHTNoMu120_IDTight_FilterHF',
+    'HLT_PFMETNoMu130_FilterHF' : 'HLT_PFMETNoMu130_PFMHTNoMu130_IDTight_FilterHF',
+    'HLT_PFMETNoMu140_FilterHF' : 'HLT_PFMETNoMu140_PFMHTNoMu140_IDTight_FilterHF',
+}
+
+def hlt_accumulator(efficiency=False, variations=False):
     """
     Returns an accumulator, mapping each histogram name to the relevant hist.Hist object.
+
+    If efficiency=True, every histogram has an additional "pass" axis after the
+    region axis, holding the trigger decision (bin 0: fail, bin 1: pass).
+    The numerator and denominator of an efficiency are then obtained from the same
+    region, see efficiency_regions() and plot.util.num_and_den().
+
+    If variations=True, every histogram has an additional "variation" axis,
+    holding the nominal result ("nominal") and the systematic variations (e.g. "jesUp").
     """
     # Axis definitions for histograms
     # Categorical axes
     dataset_ax = Cat("dataset", "Primary dataset")
     region_ax = Cat("region", "Selection region")
+    # Trigger decision, filled in one call for both passing and failing events
+    pass_ax = Bin("pass", "Trigger decision", 2, 0, 2)
+    variation_ax = Cat("variation", "Systematic variation")
+    region_axes = [region_ax]
+    if variations:
+        region_axes.append(variation_ax)
+    if efficiency:
+        region_axes.append(pass_ax)
 
     # Numerical axes
     jet_pt_ax = Bin("jetpt", r"Jet $p_{T}$ (GeV)", 200, 0, 1000)
@@ -37,27 +92,27 @@ def hlt_accumulator():
 
     # Histogram definitions
     items = {}
-    items["ak4_pt0"] = Hist("Counts", dataset_ax, region_ax, jet_pt_ax)
-    items["ak4_eta0"] = Hist("Counts", dataset_ax, region_ax, jet_eta_ax)
-    items["ak4_phi0"] = Hist("Counts", dataset_ax, region_ax, jet_phi_ax)
-    items["dimu_mass"] = Hist("Counts", dataset_ax, region_ax, dimu_mass_ax)
-    items["recoil"] = Hist("Counts", dataset_ax, region_ax, recoil_ax)
-    items["met"] = Hist("Counts", dataset_ax, region_ax, met_ax)
-    items["ht"] = Hist("Counts", dataset_ax, region_ax, ht_ax)
+    items["ak4_pt0"] = Hist("Counts", dataset_ax, *region_axes, jet_pt_ax)
+    items["ak4_eta0"] = Hist("Counts", dataset_ax, *region_axes, jet_eta_ax)
+    items["ak4_phi0"] = Hist("Counts", dataset_ax, *region_axes, jet_phi_ax)
+    items["dimu_mass"] = Hist("Counts", dataset_ax, *region_axes, dimu_mass_ax)
+    items["recoil"] = Hist("Counts", dataset_ax, *region_axes, recoil_ax)
+    items["met"] = Hist("Counts", dataset_ax, *region_axes, met_ax)
+    items["ht"] = Hist("Counts", dataset_ax, *region_axes, ht_ax)
 
-    items["z_pt"] = Hist("Counts", dataset_ax, region_ax, z_pt_ax)
+    items["z_pt"] = Hist("Counts", dataset_ax, *region_axes, z_pt_ax)
 
-    items["ak4_chf0"] = Hist("Counts", dataset_ax, region_ax, frac_ax)
-    items["ak4_nhf0"] = Hist("Counts", dataset_ax, region_ax, frac_ax)
-    items["ak4_mufrac0"] = Hist("Counts", dataset_ax, region_ax, frac_ax)
+    items["ak4_chf0"] = Hist("Counts", dataset_ax, *region_axes, frac_ax)
+    items["ak4_nhf0"] = Hist("Counts", dataset_ax, *region_axes, frac_ax)
+    items["ak4_mufrac0"] = Hist("Counts", dataset_ax, *region_axes, frac_ax)
 
-    items["ak4_abseta0_pt0"] = Hist("Counts", dataset_ax, region_ax, jet_abseta_ax, jet_pt_ax)
+    items["ak4_abseta0_pt0"] = Hist("Counts", dataset_ax, *region_axes, jet_abseta_ax, jet_pt_ax)
 
     # PU-related plots
-    items["met_npv"] = Hist("Counts", dataset_ax, region_ax, met_ax, nvtx_ax)
-    items["met_npvgood"] = Hist("Counts", dataset_ax, region_ax, met_ax, nvtx_ax)
-    items["recoil_npv"] = Hist("Counts", dataset_ax, region_ax, recoil_ax, nvtx_ax)
-    items["recoil_npvgood"] = Hist("Counts", dataset_ax, region_ax, recoil_ax, nvtx_ax)
+    items["met_npv"] = Hist("Counts", dataset_ax, *region_axes, met_ax, nvtx_ax)
+    items["met_npvgood"] = Hist("Counts", dataset_ax, *region_axes, met_ax, nvtx_ax)
+    items["recoil_npv"] = Hist("Counts", dataset_ax, *region_axes, recoil_ax, nvtx_ax)
+    items["recoil_npvgood"] = Hist("Counts", dataset_ax, *region_axes, recoil_ax, nvtx_ax)
 
     # Keep track of events that pass specific regions
     items['selected_runs'] = processor.defaultdict_accumulator(list)  
@@ -66,6 +121,9 @@ def hlt_accumulator():
 
     items['kinematics'] = processor.defaultdict_accumulator(list)
 
+    # Hash of the configuration snapshot used to produce the output
+    items['config_hash'] = processor.set_accumulator()
+
     # Return the accumulator of histograms
     return processor.dict_accumulator(items)
 
@@ -73,10 +131,14 @@ def setup_candidates(df, cfg):
     """
     Set up physics candidates as JaggedCandidateArray data structures, 
     from the given dataframe.
+
+    The kinematics are read right away, all other attributes are virtual
+    arrays, which are only read from the file if they are used.
     """
     # AK4 PF PUPPI jets
     # If we are going to manually apply different JECs, take the raw pt from NanoAOD.
     # Otherwise, get the jet pt straight out of NanoAOD.
+    njet = df['nJet'].sum()
     ak4 = JaggedCandidateArray.candidatesfromcounts(
         df['nJet'],
         pt=df['Jet_pt']*(1-df['Jet_rawFactor']) if cfg.JECS.OFFLINE.APPLY else df['Jet_pt'],
@@ -84,16 +146,16 @@ def setup_candidates(df, cfg):
         abseta=np.abs(df['Jet_eta']),
         phi=df['Jet_phi'],
         mass=np.zeros_like(df['Jet_pt']),
-        tightIdLepVeto=(df['Jet_jetId'] & 4) == 4, # bitmask: 1 = loose, 2 = tight, 3 = tight + lep veto
-        area=df['Jet_area'],
-        cef=df['Jet_chEmEF'],
-        chf=df['Jet_chHEF'],
-        nef=df['Jet_neEmEF'],
-        nhf=df['Jet_neHEF'],
-        mufrac=df['Jet_muEF'],
-        setaeta=df['Jet_hfsigmaEtaEta'],
-        sphiphi=df['Jet_hfsigmaPhiPhi'],
-        hfcentralstripsize=df['Jet_hfcentralEtaStripSize'],
+        tightIdLepVeto=lazy_branch(df, 'Jet_jetId', njet, lambda x: (x & 4) == 4, dtype=bool), # bitmask: 1 = loose, 2 = tight, 3 = tight + lep veto
+        area=lazy_branch(df, 'Jet_area', njet),
+        cef=lazy_branch(df, 'Jet_chEmEF', njet),
+        chf=lazy_branch(df, 'Jet_chHEF', njet),
+        nef=lazy_branch(df, 'Jet_neEmEF', njet),
+        nhf=lazy_branch(df, 'Jet_neHEF', njet),
+        mufrac=lazy_branch(df, 'Jet_muEF', njet),
+        setaeta=lazy_branch(df, 'Jet_hfsigmaEtaEta', njet),
+        sphiphi=lazy_branch(df, 'Jet_hfsigmaPhiPhi', njet),
+        hfcentralstripsize=lazy_branch(df, 'Jet_hfcentralEtaStripSize', njet),
     )
 
     # Offline MET, by default we use PUPPI.
@@ -101,6 +163,7 @@ def setup_candidates(df, cfg):
     met_phi = df['PuppiMET_phi']
  
     # Muons
+    nmuon = df['nMuon'].sum()
     muons = JaggedCandidateArray.candidatesfromcounts(
         df['nMuon'],
         pt=df['Muon_pt'],
@@ -108,14 +171,14 @@ def setup_candidates(df, cfg):
         abseta=np.abs(df['Muon_eta']),
         phi=df['Muon_phi'],
         mass=0 * df['Muon_pt'],
-        charge=df['Muon_charge'],
+        charge=lazy_branch(df, 'Muon_charge', nmuon),
         looseId=df['Muon_looseId'],
-        tightId=df['Muon_tightId'],
+        tightId=lazy_branch(df, 'Muon_tightId', nmuon),
         iso=df["Muon_pfRelIso04_all"],
-        dxy=df['Muon_dxy'],
-        dz=df['Muon_dz'],
-        globalmu = df['Muon_isGlobal'],
-        pfcand = df['Muon_isPFcand']
+        dxy=lazy_branch(df, 'Muon_dxy', nmuon),
+        dz=lazy_branch(df, 'Muon_dz', nmuon),
+        globalmu = lazy_branch(df, 'Muon_isGlobal', nmuon),
+        pfcand = lazy_branch(df, 'Muon_isPFcand', nmuon)
     ) 
 
     # Pre-filter: All muons must be at least loose
@@ -127,6 +190,26 @@ def setup_candidates(df, cfg):
 
     return met_pt, met_phi, ak4, muons
 
+def hlt_cut_branches(cfg):
+    """
+    Returns the following mapping:
+    Cut name -> List of branches read only for this cut
+
+    Branches which are needed in any case (jet and muon kinematics, MET,
+    run and lumi numbers) are not listed.
+    """
+    cut_branches = {
+        'leadak4_id' : ['Jet_jetId'],
+        'at_least_one_tight_mu' : ['Muon_tightId'],
+        'fail_PFHT1050' : ['HLT_PFHT1050'],
+        'filt_met' : list(cfg.FILTERS.DATA),
+    }
+    for cut, path in list(HLT_TRIGGER_CUTS.items()) + list(HLT_FILTERHF_TRIGGER_CUTS.items()):
+        cut_branches[cut] = [path]
+    if cfg.STUDIES.L1_TURNON:
+        cut_branches['L1_pass_HT1050'] = L1_SEEDS_HT1050
+    return cut_branches
+
 def hlt_regions(cfg):
     """
     Returns the following mapping:
@@ -1,40 +1,116 @@
-import copy
+import itertools
 import coffea.processor as processor
 import re
 import numpy as np
-from dynaconf import settings as cfg
 
-from coffea.lumi_tools import LumiMask
-
-from jmecofftea.hlt.definitions import hlt_accumulator, hlt_regions, setup_candidates
-from jmecofftea.helpers import jmecofftea_path, recoil, metnomu, mask_and, mask_or, object_overlap
+from jmecofftea.helpers.lumi import get_lumi_mask
+
+from jmecofftea.hlt.definitions import (
+    hlt_accumulator,
+    hlt_regions,
+    hlt_cut_branches,
+    setup_candidates,
+    HLT_TRIGGER_CUTS,
+    HLT_FILTERHF_TRIGGER_CUTS,
+    L1_SEEDS_HT1050,
+)
+from jmecofftea.helpers import jmecofftea_path, recoil, metnomu, mask_and, mask_or, object_overlap, LeadingObjectView
 from jmecofftea.helpers.dataset import extract_year
 from jmecofftea.helpers.paths import jmecofftea_path
-from jmecofftea.helpers.jme import get_jme_correctors, propagate_jecs_to_met
+from jmecofftea.helpers.config import load_config, config_hash
+from jmecofftea.helpers.selection import RegionSelection, efficiency_regions
+from jmecofftea.helpers.jme import get_jme_correctors, get_jes_uncertainty, jec_era_masks, apply_jecs, jes_variations, propagate_jec_shifts_to_met
+from jmecofftea.helpers.profiling import stage
+from jmecofftea.helpers.histograms import fill_regions
 
 class hltProcessor(processor.ProcessorABC):
     def __init__(self):
-        self._accumulator = hlt_accumulator()
+        # Resolve the configuration once, the frozen snapshot is pickled together
+        # with the processor so that workers do not need to read it again
+        self._cfg = load_config(jmecofftea_path("config/hlt.yaml"))
+        self._cfg_hash = config_hash(self._cfg)
+
+        self._accumulator = hlt_accumulator(
+            efficiency=self._cfg.RUN.EFFICIENCY_MODE,
+            variations=self._cfg.JECS.OFFLINE.VARIATIONS
+            )
 
     @property
     def accumulator(self):
         return self._accumulator
 
-    def _configure(self, df=None):
-        cfg.DYNACONF_WORKS="merge_configs"
-        cfg.MERGE_ENABLED_FOR_DYNACONF = True
-        cfg.SETTINGS_FILE_FOR_DYNACONF = jmecofftea_path("config/hlt.yaml")
+    @property
+    def config_hash(self):
+        return self._cfg_hash
 
+    @property
+    def columns(self):
+        """
+        Branches needed for every chunk with the current configuration.
+        The executor reads them in one bulk call before process() is called,
+        any other branch is still read on demand.
+
+        Branches that are only needed for cuts are included only if
+        one of the active regions uses the cut.
+        """
+        cfg = self._cfg
+        columns = [
+            'run',
+            'luminosityBlock',
+            # Jets
+            'nJet',
+            'Jet_pt',
+            'Jet_eta',
+            'Jet_phi',
+            # MET
+            'PuppiMET_pt',
+            'PuppiMET_phi',
+            # Muons
+            'nMuon',
+            'Muon_pt',
+            'Muon_eta',
+            'Muon_phi',
+            'Muon_looseId',
+            'Muon_pfRelIso04_all',
+            # Pile-up
+            'PV_npvs',
+            'PV_npvsGood',
+        ]
+
+        regions = self._active_regions()
+        cut_branches = hlt_cut_branches(cfg)
+        for cut in set(itertools.chain(*regions.values())):
+            columns += cut_branches.get(cut, [])
+
+        if cfg.JECS.OFFLINE.APPLY:
+            columns += ['Jet_rawFactor', 'Jet_area', 'Rho_fixedGridRhoFastjetAll']
+        if cfg.JECS.OFFLINE.APPLY or cfg.JECS.OFFLINE.VARIATIONS:
+            if cfg.JECS.OFFLINE.ERAS:
+                columns += ['run']
+        if cfg.RUN.KINEMATICS.SAVE or cfg.RUN.SAVE_PASSING.REGIONS:
+            columns += ['event']
+        if cfg.RUN.KINEMATICS.SAVE:
+            columns += ['Jet_chEmEF', 'Jet_neEmEF', 'Muon_tightId']
+
+        # Jet energy fractions are only filled for the fail_jet500 regions
+        if cfg.RUN.KINEMATICS.SAVE or any('fail_jet500' in region for region in regions):
+            columns += ['Jet_chHEF', 'Jet_neHEF', 'Jet_muEF']
+
+        return columns
+
+    def _active_regions(self):
+        """
+        Returns the mapping region name -> list of cuts
+        for the regions selected by cfg.RUN.REGIONS.
+        """
+        cfg = self._cfg
+        return {region : cuts for region, cuts in hlt_regions(cfg).items() if re.match(cfg.RUN.REGIONS, region)}
+
+    def _configure(self, df=None):
         if df:
             dataset = df['dataset']
             self._year = extract_year(dataset)
             df["year"] = self._year
-            
-            # Use the default config for now
-            cfg.ENV_FOR_DYNACONF = "default"
-        else:
-            cfg.ENV_FOR_DYNACONF = "default"
-        cfg.reload()
 
     def process(self, df):
         if not df.size:
@@ -42,157 +118,160 @@ class hltProcessor(processor.ProcessorABC):
         dataset = df['dataset']
 
         self._configure(df)
+        cfg = self._cfg
+
+        with stage('candidates'):
+            met_pt, met_phi, ak4, muons = setup_candidates(df, cfg)
 
-        met_pt, met_phi, ak4, muons = setup_candidates(df, cfg)
+        if cfg.JECS.OFFLINE.APPLY or cfg.JECS.OFFLINE.VARIATIONS:
+            # Pick the JEC tag for each event according to its run
+            era_masks = jec_era_masks(df['run'], cfg.JECS.OFFLINE.TAG, cfg.JECS.OFFLINE.ERAS)
 
         # Re-apply offline JECs, if configured to do so
         if cfg.JECS.OFFLINE.APPLY:
-            jme_correctors = get_jme_correctors(jecs_tag=cfg.JECS.OFFLINE.TAG)
+            with stage('jecs'):
+                jme_correctors = {tag : get_jme_correctors(jecs_tag=tag, compiled=cfg.JECS.OFFLINE.COMPILED) for tag in era_masks}
+
+                rho = ak4.pt.ones_like() * df["Rho_fixedGridRhoFastjetAll"]
+
+                # Apply the proper JECs, pre or post HCAL for data
+                # The apply_jecs() call below changes ak4.pt IN PLACE (dangerous!)
+                apply_jecs(jme_correctors, "L1L2L3", era_masks, JetPt=ak4.pt, JetEta=ak4.eta, Rho=rho, JetA=ak4.area)
+
+            with stage('met propagation'):
+                # Keep a copy of the uncorrected jet pt to fix MET
+                initial_pt = ak4.pt.flatten().copy()
+
+            with stage('jecs'):
+                apply_jecs(jme_correctors, "L2L3Res", era_masks, JetPt=ak4.pt, JetEta=ak4.eta, Rho=rho, JetA=ak4.area)
+
+            with stage('met propagation'):
+                # Update met_pt and met_phi with the new JECs
+                met_pt, met_phi = propagate_jec_shifts_to_met(met_pt, met_phi, initial_pt, ak4.pt, ak4.phi)
+
+        with stage('selections'):
+            # Implement selections
+            # Most cuts are registered as functions, which are only evaluated
+            # (and their input branches read) if one of the active regions uses them.
+            selection = RegionSelection()
+
+            pass_all = np.ones(df.size)==1
+            selection.add('inclusive', pass_all)
+
+            def lumi_mask():
+                # Create mask for events with good lumis (using the golden JSON)
+                # If no golden JSON is ready yet (i.e. early 2023 data, do not apply any filtering)
+                if df["year"] in cfg.LUMI_MASKS:
+                    # Pick the correct golden JSON for this year
+                    json = jmecofftea_path(cfg.LUMI_MASKS[df["year"]])
+                    return get_lumi_mask(json)(df["run"], df["luminosityBlock"])
+                # Apply no lumi mask filtering
+                return pass_all
+
+            selection.add('lumi_mask', lumi_mask)
+
+            # Leading jet and muon quantities as flat per-event arrays (NaN if there is none)
+            leadak4 = LeadingObjectView(ak4, ak4.pt.argmax())
+            leadmuon = LeadingObjectView(muons, muons.pt.argmax())
+
+            # Compute HT, follow the computation recipe of HLT_PFHT1050
+            ht = ak4[(ak4.pt > cfg.HT.JETPT) & (ak4.abseta < cfg.HT.ABSETA)].pt.sum()
+
+            def jet_cuts(leadak4, ht):
+                """
+                Cuts that depend on the jet energy scale, as functions of the
+                leading jet and HT. These are re-evaluated for JES variations.
+                """
+                # Selection for leading jet - whether it is within the water leak region or not
+                def leading_ak4_in_water_leak():
+                    return (leadak4.eta > 1.4) & (leadak4.eta < 2.2) & \
+                        (leadak4.phi > 1.8) & (leadak4.phi < 2.6)
+
+                # Selection for whether the leading jet is in the impacted tracker region
+                # -1.5 < eta < 0, -1.2 < phi < -0.8
+                def leading_ak4_in_bad_trk():
+                    return (leadak4.eta > -1.5) & (leadak4.eta < 0) & \
+                        (leadak4.phi > -1.2) & (leadak4.phi < -0.8)
+
+                return {
+                    # Requirements on the leading jet
+                    'leadak4_pt_eta' : lambda: (leadak4.pt > cfg.AK4.PT) & (leadak4.abseta < cfg.AK4.ABSETA),
+                    # Tight ID on leading AK4 jet
+                    'leadak4_id' : lambda: leadak4.tightIdLepVeto,
+                    'ak4_not_in_water_leak' : lambda: ~leading_ak4_in_water_leak(),
+                    'ak4_in_water_leak' : leading_ak4_in_water_leak,
+                    'ak4_not_in_bad_trk' : lambda: ~leading_ak4_in_bad_trk(),
+                    'ak4_in_bad_trk' : leading_ak4_in_bad_trk,
+                    'offline_ht_gt_1050' : lambda: ht > 1050,
+                }
+
+            for cut, function in jet_cuts(leadak4, ht).items():
+                selection.add(cut, function)
+
+            # Pick out the runs where the tracker (BPIX) issue was present
+            selection.add('bpix_issue', lambda: df["run"] > 369864)
+
+            # Trigger requirements
+            for cut, path in HLT_TRIGGER_CUTS.items():
+                selection.add(cut, lambda path=path: df[path])
+
+            # HF-filtered METNoMu120 trigger - available starting from 2022 data taking
+            for cut, path in HLT_FILTERHF_TRIGGER_CUTS.items():
+                if df['year'] >= 2022:
+                    selection.add(cut, lambda path=path: df[path])
+                else:
+                    selection.add(cut, ~pass_all)
+
+            # L1 requirement for HT1050 (only for 2022 era datasets and beyond)
+            def l1_pass_ht1050():
+                if not (df['year'] >= 2022 and cfg.STUDIES.L1_TURNON):
+                    return ~pass_all
+
+                l1_pass_ht1050 = ~pass_all
+                for seed in L1_SEEDS_HT1050:
+                    l1_pass_ht1050 |= df[seed]
+                return l1_pass_ht1050
 
-            rho = ak4.pt.ones_like() * df["Rho_fixedGridRhoFastjetAll"]
+            selection.add('L1_pass_HT1050', l1_pass_ht1050)
 
-            # Apply the proper JECs, pre or post HCAL for data
-            # The getCorrection() call below changes ak4.pt IN PLACE (dangerous!)
-            jme_correctors["L1L2L3"].getCorrection(JetPt=ak4.pt, JetEta=ak4.eta, Rho=rho, JetA=ak4.area)
+            # Selection to pick tight offline muons
+            def at_least_one_tight_mu():
+                is_tight_muon = muons.tightId \
+                              & (muons.iso < cfg.MUON.CUTS.TIGHT.ISO) \
+                              & (muons.pt > cfg.MUON.CUTS.TIGHT.PT) \
+                              & (muons.abseta < cfg.MUON.CUTS.TIGHT.ETA)
+                return is_tight_muon.any()
 
-            # Keep a copy of uncorrected 4-momenta to fix MET
-            initial_p4 = copy.deepcopy(ak4.p4)
-            jme_correctors["L2L3Res"].getCorrection(JetPt=ak4.pt, JetEta=ak4.eta, Rho=rho, JetA=ak4.area)
+            # W -> mu+nu region
+            selection.add('one_muon', lambda: muons.counts==1)
+            selection.add('muon_pt>30', lambda: muons.pt.max() > cfg.MUON.CUTS.TIGHT.PT)
+            selection.add('at_least_one_tight_mu', at_least_one_tight_mu)
 
-            # Update met_pt and met_phi with the new JECs
-            met_pt, met_phi = propagate_jecs_to_met(met_pt, met_phi, initial_p4, ak4.p4)
+            selection.add('fail_PFHT1050', lambda: ~df["HLT_PFHT1050"])
 
-        # Implement selections
-        selection = processor.PackedSelection()
+            # Recoil
+            df['recoil_pt'], df['recoil_phi'] = metnomu(met_pt, met_phi, muons)
 
-        pass_all = np.ones(df.size)==1
-        selection.add('inclusive', pass_all)
+            # Cuts to pick specific run ranges as specified in the configuration
+            for label, run_range in cfg.RUN.RANGES.items():
+                run_min, run_max = run_range
+                selection.add(f'cut_{label}', lambda run_min=run_min, run_max=run_max: (df['run'] >= run_min) & (df['run'] <= run_max))
 
-        # Create mask for events with good lumis (using the golden JSON)
-        # If no golden JSON is ready yet (i.e. early 2023 data, do not apply any filtering)
-        if df["year"] in cfg.LUMI_MASKS:
-            # Pick the correct golden JSON for this year
-            json = jmecofftea_path(cfg.LUMI_MASKS[df["year"]])
-            lumi_mask = LumiMask(json)(df["run"], df["luminosityBlock"])
+            # MET filters
+            selection.add('filt_met', lambda: mask_and(df, cfg.FILTERS.DATA))
         
-        # Apply no lumi mask filtering
-        else:
-            lumi_mask = pass_all
-
-        selection.add('lumi_mask', lumi_mask)
-
-        # Requirements on the leading jet
-        leadak4_index = ak4.pt.argmax()
-        leadak4_pt_eta = (ak4.pt.max() > cfg.AK4.PT) & (ak4.abseta[leadak4_index] < cfg.AK4.ABSETA)
-        selection.add('leadak4_pt_eta', leadak4_pt_eta.any())
-
-        # Compute HT, follow the computation recipe of HLT_PFHT1050
-        ht = ak4[(ak4.pt > cfg.HT.JETPT) & (ak4.abseta < cfg.HT.ABSETA)].pt.sum()
-
-        # Tight ID on leading AK4 jet
-        selection.add('leadak4_id', (ak4.tightIdLepVeto[leadak4_index].any()))
-
-        # Selection for leading jet - whether it is within the water leak region or not
-        leading_ak4_in_water_leak = ((ak4[leadak4_index].eta > 1.4) & (ak4[leadak4_index].eta < 2.2) & \
-            (ak4[leadak4_index].phi > 1.8) & (ak4[leadak4_index].phi < 2.6))
-
-        selection.add('ak4_not_in_water_leak', ~leading_ak4_in_water_leak.any())
-        selection.add('ak4_in_water_leak', leading_ak4_in_water_leak.any())
-
-        # Selection for whether the leading jet is in the impacted tracker region
-        # -1.5 < eta < 0, -1.2 < phi < -0.8
-        leading_ak4_in_bad_trk = ((ak4[leadak4_index].eta > -1.5) & (ak4[leadak4_index].eta < 0) & \
-            (ak4[leadak4_index].phi > -1.2) & (ak4[leadak4_index].phi < -0.8))
-
-        selection.add('ak4_not_in_bad_trk', ~leading_ak4_in_bad_trk.any())
-        selection.add('ak4_in_bad_trk', leading_ak4_in_bad_trk.any())
-        # Pick out the runs where the tracker (BPIX) issue was present
-        selection.add('bpix_issue', df["run"] > 369864)
-
-        # Trigger requirements: MET
-        selection.add('HLT_PFMET120', df['HLT_PFMET120_PFMHT120_IDTight'])
-        selection.add('HLT_PFMETNoMu120', df['HLT_PFMETNoMu120_PFMHTNoMu120_IDTight'])
-        # Jet500 + HT1050 triggers
-        selection.add('HLT_PFJet500', df['HLT_PFJet500'])
-        selection.add('HLT_PFHT1050', df['HLT_PFHT1050'])
-        # Single Muon trigger
-        selection.add('HLT_IsoMu27', df['HLT_IsoMu27'])
-
-        # HF-filtered METNoMu120 trigger - available starting from 2022 data taking
-        if df['year'] >= 2022:        
-            selection.add('HLT_PFMETNoMu110_FilterHF', df['HLT_PFMETNoMu110_PFMHTNoMu110_IDTight_FilterHF'])
-            selection.add('HLT_PFMETNoMu120_FilterHF', df['HLT_PFMETNoMu120_PFMHTNoMu120_IDTight_FilterHF'])
-            selection.add('HLT_PFMETNoMu130_FilterHF', df['HLT_PFMETNoMu130_PFMHTNoMu130_IDTight_FilterHF'])
-            selection.add('HLT_PFMETNoMu140_FilterHF', df['HLT_PFMETNoMu140_PFMHTNoMu140_IDTight_FilterHF'])
-        else:
-            selection.add('HLT_PFMETNoMu110_FilterHF', ~pass_all)
-            selection.add('HLT_PFMETNoMu120_FilterHF', ~pass_all)
-            selection.add('HLT_PFMETNoMu130_FilterHF', ~pass_all)
-            selection.add('HLT_PFMETNoMu140_FilterHF', ~pass_all)
-
-        # L1 requirement for HT1050 (only for 2022 era datasets and beyond)
-        if df['year'] >= 2022 and cfg.STUDIES.L1_TURNON:
-            l1_seeds = [
-                'L1_HTT120er',
-                'L1_HTT160er',
-                'L1_HTT200er',
-                'L1_HTT255er',
-                'L1_HTT280er',
-                'L1_HTT280er_QuadJet_70_55_40_35_er2p5',
-                'L1_HTT320er_QuadJet_80_60_er2p1_45_40_er2p3',
-                'L1_HTT320er_QuadJet_80_60_er2p1_50_45_er2p3',
-                'L1_HTT320er',
-                'L1_HTT360er',
-                'L1_ETT2000',
-                'L1_HTT400er',
-                'L1_HTT450er',
-            ]
-            
-            l1_pass_ht1050 = ~pass_all
-
-            for seed in l1_seeds:
-                l1_pass_ht1050 |= df[seed]
-        
-            selection.add('L1_pass_HT1050', l1_pass_ht1050)
-        
-        else:
-            selection.add('L1_pass_HT1050', ~pass_all)
-
-        # Selection to pick tight offline muons
-        df['is_tight_muon'] = muons.tightId \
-                      & (muons.iso < cfg.MUON.CUTS.TIGHT.ISO) \
-                      & (muons.pt > cfg.MUON.CUTS.TIGHT.PT) \
-                      & (muons.abseta < cfg.MUON.CUTS.TIGHT.ETA)
-
-        # W -> mu+nu region
-        leadmuon_index=muons.pt.argmax()
-        selection.add('one_muon', muons.counts==1)
-        selection.add('muon_pt>30', muons.pt.max() > cfg.MUON.CUTS.TIGHT.PT)
-        selection.add('at_least_one_tight_mu', df['is_tight_muon'].any())
-
-        selection.add('offline_ht_gt_1050', ht > 1050)
-        selection.add('fail_PFHT1050', ~df["HLT_PFHT1050"])
-
-        # Recoil
-        df['recoil_pt'], df['recoil_phi'] = metnomu(met_pt, met_phi, muons)
-
-        # Cuts to pick specific run ranges as specified in the configuration
-        for label, run_range in cfg.RUN.RANGES.items():
-            run_min, run_max = run_range
-            run_mask = (df['run'] >= run_min) & (df['run'] <= run_max)
-            selection.add(f'cut_{label}', run_mask)
-
-        # MET filters
-        selection.add('filt_met', mask_and(df, cfg.FILTERS.DATA)) 
-        
-        # Selection to get high PU (=60) fill
-        selection.add("pu60_fill", (df["run"] >= 362613) & (df["run"] <= 362618))
+            # Selection to get high PU (=60) fill
+            selection.add("pu60_fill", lambda: (df["run"] >= 362613) & (df["run"] <= 362618))
 
         # Fill histograms
         output = self.accumulator.identity()
+        output['config_hash'].add(self._cfg_hash)
 
         # Save kinematics for specific events
         if cfg.RUN.KINEMATICS.SAVE:
+            # Jagged arrays with the leading object (if any) of each event, as read by scripts/read_kinematics.py
+            ak4_lead = ak4[ak4.pt.argmax()]
+            muon_lead = muons[muons.pt.argmax()]
             for event in cfg.RUN.KINEMATICS.EVENTS:
                 event_mask = df['event'] == event
 
@@ -201,64 +280,123 @@ class hltProcessor(processor.ProcessorABC):
 
                 output['kinematics']['event'] += [event]
 
-                output['kinematics']['ak4_pt0'] += [ak4[leadak4_index][event_mask].pt]            
-                output['kinematics']['ak4_eta0'] += [ak4[leadak4_index][event_mask].eta]            
-                output['kinematics']['ak4_phi0'] += [ak4[leadak4_index][event_mask].phi]            
-                output['kinematics']['ak4_tightId0'] += [ak4[leadak4_index][event_mask].looseId]            
+                output['kinematics']['ak4_pt0'] += [ak4_lead[event_mask].pt]
+                output['kinematics']['ak4_eta0'] += [ak4_lead[event_mask].eta]
+                output['kinematics']['ak4_phi0'] += [ak4_lead[event_mask].phi]
+                # Jets do not have a loose ID, store the tight lepton veto ID used in the selection
+                output['kinematics']['ak4_tightId0'] += [ak4_lead[event_mask].tightIdLepVeto]
                 
-                output['kinematics']['ak4_nhf0'] += [ak4[leadak4_index][event_mask].nhf]
-                output['kinematics']['ak4_nef0'] += [ak4[leadak4_index][event_mask].nef]
-                output['kinematics']['ak4_chf0'] += [ak4[leadak4_index][event_mask].chf]
-                output['kinematics']['ak4_cef0'] += [ak4[leadak4_index][event_mask].cef]
-                output['kinematics']['ak4_mufrac0'] += [ak4[leadak4_index][event_mask].mufrac]
-
-                output['kinematics']['mu_pt0'] += [muons[leadmuon_index][event_mask].pt]
-                output['kinematics']['mu_eta0'] += [muons[leadmuon_index][event_mask].eta]
-                output['kinematics']['mu_phi0'] += [muons[leadmuon_index][event_mask].phi]
-                output['kinematics']['mu_tightId0'] += [muons[leadmuon_index][event_mask].tightId]
-
-        regions = hlt_regions(cfg)
-	
-        for region, cuts in regions.items():
-            # Only run on the regions we want to run
-            if not re.match(cfg.RUN.REGIONS, region):
-                continue
-
-            mask = selection.all(*cuts)
-
+                output['kinematics']['ak4_nhf0'] += [ak4_lead[event_mask].nhf]
+                output['kinematics']['ak4_nef0'] += [ak4_lead[event_mask].nef]
+                output['kinematics']['ak4_chf0'] += [ak4_lead[event_mask].chf]
+                output['kinematics']['ak4_cef0'] += [ak4_lead[event_mask].cef]
+                output['kinematics']['ak4_mufrac0'] += [ak4_lead[event_mask].mufrac]
+
+                output['kinematics']['mu_pt0'] += [muon_lead[event_mask].pt]
+                output['kinematics']['mu_eta0'] += [muon_lead[event_mask].eta]
+                output['kinematics']['mu_phi0'] += [muon_lead[event_mask].phi]
+                output['kinematics']['mu_tightId0'] += [muon_lead[event_mask].tightId]
+
+        # Only run on the regions we want to run
+        regions = self._active_regions()
+        if cfg.RUN.EFFICIENCY_MODE:
+            # Fill each denominator region once, with the trigger decision on the pass axis
+            regions_to_fill = efficiency_regions(regions)
+        else:
+            regions_to_fill = {region : (cuts, None) for region, cuts in regions.items()}
+        region_names = list(regions_to_fill.keys())
+
+        def region_masks(selection):
+            """
+            Event masks of all regions, so that each histogram is filled for all regions at once,
+            and the trigger decision of each event in each region (all pass if there is no trigger cut).
+            This is where the deferred cuts are evaluated.
+            """
+            membership = np.array([selection.all(*cuts) for cuts, _ in regions_to_fill.values()], dtype=bool).reshape(len(region_names), df.size)
+            if cfg.RUN.EFFICIENCY_MODE:
+                passing = np.array([selection.all(*(pass_cuts or [])) for _, pass_cuts in regions_to_fill.values()], dtype=int).reshape(membership.shape)
+            else:
+                passing = None
+            return membership, passing
+
+        with stage('cut evaluation'):
+            membership, passing = region_masks(selection)
+
+        with stage('region loop'):
             # Save (run,lumi,event) information for specified regions
-            if region in cfg.RUN.SAVE_PASSING.REGIONS:
+            for region in cfg.RUN.SAVE_PASSING.REGIONS:
+                if region not in regions:
+                    continue
+                mask = selection.all(*regions[region])
                 output['selected_runs'][region] += list(df['run'][mask])
                 output['selected_lumis'][region] += list(df['luminosityBlock'][mask])
                 output['selected_events'][region] += list(df['event'][mask])
 
-            def ezfill(name, **kwargs):
-                """Helper function to make filling easier."""
-                output[name].fill(
-                    region=region, 
-                    dataset=dataset, 
-                    **kwargs
-                    )
-
-            ezfill('ak4_eta0',   jeteta=ak4[leadak4_index].eta[mask].flatten())
-            ezfill('ak4_phi0',   jetphi=ak4[leadak4_index].phi[mask].flatten())
-            ezfill('ak4_pt0',    jetpt=ak4[leadak4_index].pt[mask].flatten())
-            ezfill('recoil',     recoil=df['recoil_pt'][mask])                      
-            ezfill('met',        met=met_pt[mask])
-            ezfill('ht',         ht=ht[mask])
-
-            ezfill('ak4_abseta0_pt0',   jeteta=ak4[leadak4_index].abseta[mask].flatten(), jetpt=ak4[leadak4_index].pt[mask].flatten())
-
-            # PU plots -> Number of vertices vs. MET/METNoMu
-            ezfill('met_npv',          met=met_pt[mask],   nvtx=df["PV_npvs"][mask])
-            ezfill('met_npvgood',      met=met_pt[mask],   nvtx=df["PV_npvsGood"][mask])
-            ezfill('recoil_npv',       recoil=df["recoil_pt"][mask],  nvtx=df["PV_npvs"][mask])
-            ezfill('recoil_npvgood',   recoil=df["recoil_pt"][mask],  nvtx=df["PV_npvsGood"][mask])
-
-            if 'fail_jet500' in region:
-                ezfill('ak4_chf0',     frac=ak4[leadak4_index].chf[mask].flatten())
-                ezfill('ak4_nhf0',     frac=ak4[leadak4_index].nhf[mask].flatten())
-                ezfill('ak4_mufrac0',  frac=ak4[leadak4_index].mufrac[mask].flatten())
+            def fill_histograms(membership, passing, leadak4, ht, met_pt, recoil_pt, variation):
+                """
+                Fill all histograms for all regions, with the given region masks and
+                the jet and MET quantities of the given systematic variation.
+                """
+                def ezfill(name, rows=None, valid=None, **kwargs):
+                    """
+                    Helper function to make filling easier.
+                    Fills the regions with the given row indices, or all regions.
+                    Only events where valid is True are filled, e.g. events with a leading jet.
+                    """
+                    if rows is None:
+                        rows = list(range(len(region_names)))
+                    if not rows:
+                        return
+                    if passing is not None:
+                        kwargs['pass'] = passing[rows]
+                    if cfg.JECS.OFFLINE.VARIATIONS:
+                        kwargs['variation'] = variation
+                    with stage('histogram fills'):
+                        fill_regions(
+                            output[name],
+                            regions=[region_names[i] for i in rows],
+                            membership=membership[rows] if valid is None else membership[rows] & valid,
+                            dataset=dataset,
+                            **kwargs
+                            )
+
+                ezfill('ak4_eta0',   jeteta=leadak4.eta, valid=leadak4.valid)
+                ezfill('ak4_phi0',   jetphi=leadak4.phi, valid=leadak4.valid)
+                ezfill('ak4_pt0',    jetpt=leadak4.pt, valid=leadak4.valid)
+                ezfill('recoil',     recoil=recoil_pt)
+                ezfill('met',        met=met_pt)
+                ezfill('ht',         ht=ht)
+
+                ezfill('ak4_abseta0_pt0',   jeteta=leadak4.abseta, jetpt=leadak4.pt, valid=leadak4.valid)
+
+                # PU plots -> Number of vertices vs. MET/METNoMu
+                ezfill('met_npv',          met=met_pt,   nvtx=df["PV_npvs"])
+                ezfill('met_npvgood',      met=met_pt,   nvtx=df["PV_npvsGood"])
+                ezfill('recoil_npv',       recoil=recoil_pt,  nvtx=df["PV_npvs"])
+                ezfill('recoil_npvgood',   recoil=recoil_pt,  nvtx=df["PV_npvsGood"])
+
+                fail_jet500_rows = [i for i, region in enumerate(region_names) if 'fail_jet500' in region]
+                ezfill('ak4_chf0',     rows=fail_jet500_rows, frac=leadak4.chf, valid=leadak4.valid)
+                ezfill('ak4_nhf0',     rows=fail_jet500_rows, frac=leadak4.nhf, valid=leadak4.valid)
+                ezfill('ak4_mufrac0',  rows=fail_jet500_rows, frac=leadak4.mufrac, valid=leadak4.valid)
+
+            fill_histograms(membership, passing, leadak4, ht, met_pt, df['recoil_pt'], variation='nominal')
+
+        # JES variations: Only the jet and MET quantities and the cuts depending on them
+        # are recomputed, all other masks (and their ANDs) are shared with the nominal selection
+        if cfg.JECS.OFFLINE.VARIATIONS:
+            with stage('jes variations'):
+                uncertainties = {tag : get_jes_uncertainty(tag) for tag in era_masks}
+                for variation, pt_var in jes_variations(uncertainties, era_masks, ak4.pt, ak4.eta).items():
+                    leadak4_var = LeadingObjectView(ak4, pt_var.argmax(), pt=pt_var)
+                    ht_var = pt_var[(pt_var > cfg.HT.JETPT) & (ak4.abseta < cfg.HT.ABSETA)].sum()
+                    met_pt_var, met_phi_var = propagate_jec_shifts_to_met(met_pt, met_phi, ak4.pt.flatten(), pt_var, ak4.phi)
+                    recoil_pt_var, _ = metnomu(met_pt_var, met_phi_var, muons)
+
+                    selection_var = selection.varied(jet_cuts(leadak4_var, ht_var))
+                    with stage('cut evaluation'):
+                        membership_var, passing_var = region_masks(selection_var)
+                    fill_histograms(membership_var, passing_var, leadak4_var, ht_var, met_pt_var, recoil_pt_var, variation=variation)
 
         return output
 
@@ -6,6 +6,18 @@ import numpy as np
 
 from coffea.analysis_objects import JaggedCandidateArray
 
+from jmecofftea.helpers import lazy_branch
+
+# Triggers of interest
+JMENANO_TRIGGERS = [
+    "HLT_PFJet60",
+    "HLT_PFJet140",
+    "HLT_PFJet320",
+    "HLT_PFJetFwd60",
+    "HLT_PFJetFwd140",
+    "HLT_PFJetFwd320",
+]
+
 def setup_candidates_for_jmenano(df, cfg):
     """
     Set up physics candidates as JaggedCandidateArray data structures, 
@@ -20,6 +32,7 @@ def setup_candidates_for_jmenano(df, cfg):
         mass=df["offlineAK4PFPuppiJetsCorrected_mass"],
     )
 
+    nmuon = df["offlineMuons_multiplicity"].sum()
     muons = JaggedCandidateArray.candidatesfromcounts(
         df["offlineMuons_multiplicity"],
         pt=df["offlineMuons_pt"],
@@ -28,8 +41,8 @@ def setup_candidates_for_jmenano(df, cfg):
         phi=df["offlineMuons_phi"],
         mass=df["offlineMuons_pt"] * 0.,
         pdgId=df["offlineMuons_pdgId"],
-        dxy=df["offlineMuons_dxyPV"],
-        dz=df["offlineMuons_dzPV"],
+        dxy=lazy_branch(df, "offlineMuons_dxyPV", nmuon),
+        dz=lazy_branch(df, "offlineMuons_dzPV", nmuon),
     )
 
     return ak4, muons
@@ -2,30 +2,65 @@ import copy
 import coffea.processor as processor
 import re
 import numpy as np
-from dynaconf import settings as cfg
 
-from coffea.lumi_tools import LumiMask
+from jmecofftea.helpers.lumi import get_lumi_mask
 
 from jmecofftea.hlt.definitions import hlt_accumulator, hlt_regions
-from jmecofftea.jmenano.definitions import setup_candidates_for_jmenano, regions_for_jmenano
+from jmecofftea.jmenano.definitions import setup_candidates_for_jmenano, regions_for_jmenano, JMENANO_TRIGGERS
 
 from jmecofftea.helpers import jmecofftea_path, recoil, metnomu, mask_and, mask_or, object_overlap
 from jmecofftea.helpers.dataset import extract_year
 from jmecofftea.helpers.paths import jmecofftea_path
+from jmecofftea.helpers.config import load_config, config_hash
+from jmecofftea.helpers.selection import RegionSelection, efficiency_regions
 
 class jmeNanoProcessor(processor.ProcessorABC):
     def __init__(self):
-        self._accumulator = hlt_accumulator()
+        # Resolve the configuration once, the frozen snapshot is pickled together
+        # with the processor so that workers do not need to read it again
+        self._cfg = load_config(jmecofftea_path("config/hlt.yaml"))
+        self._cfg_hash = config_hash(self._cfg)
+
+        self._accumulator = hlt_accumulator(efficiency=self._cfg.RUN.EFFICIENCY_MODE)
     
     @property
     def accumulator(self):
         return self._accumulator
 
-    def _configure(self, df=None):
-        cfg.DYNACONF_WORKS="merge_configs"
-        cfg.MERGE_ENABLED_FOR_DYNACONF = True
-        cfg.SETTINGS_FILE_FOR_DYNACONF = jmecofftea_path("config/hlt.yaml")
+    @property
+    def config_hash(self):
+        return self._cfg_hash
+
+    @property
+    def columns(self):
+        """
+        Branches needed for every chunk. The executor reads them in one bulk
+        call before process() is called, any other branch is still read on demand.
+        """
+        columns = [
+            'run',
+            'luminosityBlock',
+            # Jets
+            'offlineAK4PFPuppiJetsCorrected_multiplicity',
+            'offlineAK4PFPuppiJetsCorrected_pt',
+            'offlineAK4PFPuppiJetsCorrected_eta',
+            'offlineAK4PFPuppiJetsCorrected_phi',
+            'offlineAK4PFPuppiJetsCorrected_mass',
+            # Muons
+            'offlineMuons_multiplicity',
+            'offlineMuons_pt',
+            'offlineMuons_eta',
+            'offlineMuons_phi',
+            'offlineMuons_pdgId',
+            # Triggers
+            'HLT_IsoMu27_HLTPathAccept',
+            'HLT_IsoMu27_HLTPathPrescaled',
+        ]
+        for trigger in JMENANO_TRIGGERS:
+            columns += [f"{trigger}_HLTPathAccept", f"{trigger}_HLTPathPrescaled"]
+        return columns
 
+    def _configure(self, df=None):
         if df:
             dataset = df['dataset']
             # Try to determine dataset year from dataset name.
@@ -35,13 +70,6 @@ class jmeNanoProcessor(processor.ProcessorABC):
             except RuntimeError:
                 self._year = -1
             df["year"] = self._year
-            
-            # Use the default config for now
-            cfg.ENV_FOR_DYNACONF = "default"
-        else:
-            cfg.ENV_FOR_DYNACONF = "default"
-        
-        cfg.reload()
 
     def process(self, df):
         if not df.size:
@@ -49,11 +77,12 @@ class jmeNanoProcessor(processor.ProcessorABC):
         dataset = df['dataset']
 
         self._configure(df)
+        cfg = self._cfg
 
         ak4, muons = setup_candidates_for_jmenano(df, cfg)
     
         # Implement selections
-        selection = processor.PackedSelection()
+        selection = RegionSelection()
         pass_all = np.ones(df.size)==1
         selection.add('inclusive', pass_all)
 
@@ -62,7 +91,7 @@ class jmeNanoProcessor(processor.ProcessorABC):
         if df["year"] in cfg.LUMI_MASKS:
             # Pick the correct golden JSON for this year
             json_path = jmecofftea_path(cfg.LUMI_MASKS[df["year"]])
-            lumi_mask = LumiMask(json_path)(df["run"], df["luminosityBlock"])
+            lumi_mask = get_lumi_mask(json_path)(df["run"], df["luminosityBlock"])
         
         # Apply no lumi mask filtering
         else:
@@ -101,14 +130,7 @@ class jmeNanoProcessor(processor.ProcessorABC):
         selection.add("lead_ak4_in_barrel", ak4_in_barrel.any())
 
         # Trigger cuts
-        triggers = [
-            "HLT_PFJet60",
-            "HLT_PFJet140",
-            "HLT_PFJet320",
-            "HLT_PFJetFwd60",
-            "HLT_PFJetFwd140",
-            "HLT_PFJetFwd320",
-        ]
+        triggers = JMENANO_TRIGGERS
 
         for trigger in triggers:
             selection.add(f"{trigger}_accepted", df[f"{trigger}_HLTPathAccept"])
@@ -120,14 +142,32 @@ class jmeNanoProcessor(processor.ProcessorABC):
 
         # Fill histograms for each region
         output = self.accumulator.identity()
+        output['config_hash'].add(self._cfg_hash)
 
         regions = regions_for_jmenano()
 
-        for region, cuts in regions.items():
+        if cfg.RUN.EFFICIENCY_MODE:
+            # Fill each denominator region once, with the trigger decision on the pass axis
+            fill_regions = efficiency_regions(regions)
+        else:
+            fill_regions = {region : (cuts, None) for region, cuts in regions.items()}
+
+        for region, (cuts, pass_cuts) in fill_regions.items():
             mask = selection.all(*cuts)
 
-            def ezfill(name, **kwargs):
-                """Helper function to make filling easier."""
+            # Trigger decision for the events in the region (all pass if there is no trigger cut)
+            if cfg.RUN.EFFICIENCY_MODE:
+                passing = selection.all(*pass_cuts)[mask].astype(int) if pass_cuts else np.ones(mask.sum(), dtype=int)
+            else:
+                passing = None
+
+            def ezfill(name, counts=None, **kwargs):
+                """
+                Helper function to make filling easier.
+                For jagged quantities, counts gives the number of entries per selected event.
+                """
+                if passing is not None:
+                    kwargs['pass'] = passing if counts is None else np.repeat(passing, counts)
                 output[name].fill(
                     region=region, 
                     dataset=dataset, 
@@ -135,12 +175,12 @@ class jmeNanoProcessor(processor.ProcessorABC):
                 )
 
             # Kinematics of the leading jet
-            ezfill("ak4_pt0",     jetpt=ak4[leadak4_index].pt[mask].flatten())
-            ezfill("ak4_eta0",    jeteta=ak4[leadak4_index].eta[mask].flatten())
-            ezfill("ak4_phi0",    jetphi=ak4[leadak4_index].phi[mask].flatten())
+            ezfill("ak4_pt0",     jetpt=ak4[leadak4_index].pt[mask].flatten(), counts=ak4[leadak4_index].counts[mask])
+            ezfill("ak4_eta0",    jeteta=ak4[leadak4_index].eta[mask].flatten(), counts=ak4[leadak4_index].counts[mask])
+            ezfill("ak4_phi0",    jetphi=ak4[leadak4_index].phi[mask].flatten(), counts=ak4[leadak4_index].counts[mask])
 
             # Z boson pt
-            ezfill("z_pt",        pt=dimuons.pt[mask].flatten())
+            ezfill("z_pt",        pt=dimuons.pt[mask].flatten(), counts=dimuons.counts[mask])
 
         return output
 
@@ -13,6 +13,7 @@ from klepto.archives import dir_archive
 from tqdm import tqdm
 
 from jmecofftea.plot.style import trigger_names, binnings, markers, trigger_labels
+from jmecofftea.plot.util import num_and_den
 
 pjoin = os.path.join
 
@@ -85,8 +86,7 @@ def compare_turnons_for_diff_datasets(acc, outdir, datasets, labels, region, use
     h = get_histogram(acc, region)
 
     # Get the histograms for numerator and denominator
-    h_num = h.integrate('region', f'{region}_num')
-    h_den = h.integrate('region', f'{region}_den')
+    h_num, h_den = num_and_den(h, region)
 
     error_opts = markers("data")
 
@@ -166,8 +166,7 @@ def compare_turnons_for_diff_regions(acc, outdir, region_tags, base_region, data
 
     for region_tag in region_tags:
         # Get the histograms for numerator and denominator regions
-        h_num = h.integrate("region", f"{base_region}_{region_tag}_num")
-        h_den = h.integrate("region", f"{base_region}_{region_tag}_den")
+        h_num, h_den = num_and_den(h, f"{base_region}_{region_tag}")
 
         hist.plotratio(
             h_num,
@@ -41,6 +41,7 @@ from jmecofftea.plot.style import (
     get_variable_for_trigger,
     get_list_of_triggers
 )
+from jmecofftea.plot.util import num_and_den
 
 pjoin = os.path.join
 
@@ -85,8 +86,7 @@ def plot_efficiency_for_trigger(acc, outdir, trigger, dataset):
     h = h.rebin(new_bins.name, new_bins)
 
     # Get the numerator and denominator histograms
-    h_num = h.integrate("region", f"{trigger}_num")
-    h_den = h.integrate("region", f"{trigger}_den")
+    h_num, h_den = num_and_den(h, trigger)
 
     # Plot the efficiency
     fig, ax = plt.subplots()
@@ -35,6 +35,7 @@ from jmecofftea.plot.style import (
     get_variable_for_trigger,
     get_list_of_triggers
 )
+from jmecofftea.plot.util import num_and_den
 
 pjoin = os.path.join
 
@@ -67,12 +68,18 @@ def plot_num_and_den(acc, outdir, trigger, dataset, logy=True):
     new_bins = get_binning_for_trigger(trigger)
     h = h.rebin(new_bins.name, new_bins)
 
-    # Filter the regions in the histogram
-    histo = h[re.compile(f"{trigger}.*")]
-
     # Plot
     fig, ax = plt.subplots()
-    hist.plot1d(histo, ax=ax, overlay="region")
+    if 'pass' in [a.name for a in h.axes()]:
+        # Efficiency mode: Numerator and denominator are taken from the pass axis
+        h_num, h_den = num_and_den(h, trigger)
+        hist.plot1d(h_num, ax=ax, clear=False)
+        hist.plot1d(h_den, ax=ax, clear=False)
+        ax.legend(labels=[f"{trigger}_num", f"{trigger}_den"])
+    else:
+        # Filter the regions in the histogram
+        histo = h[re.compile(f"{trigger}.*")]
+        hist.plot1d(histo, ax=ax, overlay="region")
 
     if logy:
         ax.set_yscale("log")
@@ -15,6 +15,8 @@ from klepto.archives import dir_archive
 from tqdm import tqdm
 from tabulate import tabulate
 
+from jmecofftea.plot.util import num_and_den
+
 # Ignore division warnings from Coffea + Numpy
 warnings.filterwarnings('ignore', category=RuntimeWarning)
 
@@ -144,8 +146,7 @@ def plot_turnons_for_different_runs(
         new_ax = NEW_BINS[distribution]
         h = h.rebin(new_ax.name, new_ax)
 
-    h_num = h.integrate('region', f'{region}_num')
-    h_den = h.integrate('region', f'{region}_den')
+    h_num, h_den = num_and_den(h, region)
 
     fig, ax = plt.subplots()
 
@@ -298,8 +299,7 @@ def plot_turnons_by_eta(acc, outdir, region, datasets):
         # Integrate the eta slice for the leading jet
         histo = h.integrate('jeteta', etaslice)
 
-        h_num = histo.integrate('region', f'{region}_num')
-        h_den = histo.integrate('region', f'{region}_den')
+        h_num, h_den = num_and_den(histo, region)
 
         fig, ax = plt.subplots()
 
@@ -351,8 +351,7 @@ def plot_eta_efficiency(acc, outdir, region, datasets):
         new_ax = NEW_BINS[distribution]
         h = h.rebin(new_ax.name, new_ax)
 
-    h_num = h.integrate('region', f'{region}_num')
-    h_den = h.integrate('region', f'{region}_den')
+    h_num, h_den = num_and_den(h, region)
 
     fig, ax = plt.subplots()
 
@@ -406,14 +405,8 @@ def plot_turnons_with_without_water_leak(acc, outdir, dataset='Muon.*2022E'):
     h = h.integrate('dataset', re.compile(dataset))
 
     histos = {}
-    histos['water_leak'] = {
-        'num' : h.integrate('region', 'tr_jet_water_leak_num'),
-        'den' : h.integrate('region', 'tr_jet_water_leak_den'),
-    }
-    histos['no_water_leak'] = {
-        'num' : h.integrate('region', 'tr_jet_water_leak_veto_num'),
-        'den' : h.integrate('region', 'tr_jet_water_leak_veto_den'),
-    }
+    histos['water_leak'] = dict(zip(('num', 'den'), num_and_den(h, 'tr_jet_water_leak')))
+    histos['no_water_leak'] = dict(zip(('num', 'den'), num_and_den(h, 'tr_jet_water_leak_veto')))
 
     # Plot the two turn-ons side by side
     fig, ax = plt.subplots()
@@ -466,15 +459,9 @@ def plot_l1_vs_hlt_HT1050(acc, outdir, dataset='Muon.*2022E.*'):
 
     # Get the histograms for L1 and HLT turn-ons
     histos = {}
-    histos['hlt_ht1050'] = {
-        'num' : h.integrate('region', 'tr_ht_num'),
-        'den' : h.integrate('region', 'tr_ht_den'),
-    }
+    histos['hlt_ht1050'] = dict(zip(('num', 'den'), num_and_den(h, 'tr_ht')))
 
-    histos['l1_ht1050'] = {
-        'num' : h.integrate('region', 'tr_l1_ht_num'),
-        'den' : h.integrate('region', 'tr_l1_ht_den'),
-    }
+    histos['l1_ht1050'] = dict(zip(('num', 'den'), num_and_den(h, 'tr_l1_ht')))
 
     fig, ax = plt.subplots()
 
@@ -545,8 +532,7 @@ def plot_efficiency_vs_nvtx(acc,
 
         # Get the num and denom histograms and plot!
         hist.plotratio(
-            histo.integrate('region', f'{region}_num'),
-            histo.integrate('region', f'{region}_den'),
+            *num_and_den(histo, region),
             ax=ax,
             error_opts=error_opts,
             label=f'Offline $p_{{T,no-\\mu}}^{{miss}} > {recoil_slice.start:.0f} \\ GeV$',
@@ -627,8 +613,7 @@ def plot_turnon_wrt_nvtx(acc, outdir, region, distribution, dataset='Muon.*2022[
         histo = h.integrate('nvtx', nvtx_bin)
 
         hist.plotratio(
-            histo.integrate('region', f'{region}_num'),
-            histo.integrate('region', f'{region}_den'),
+            *num_and_den(histo, region),
             ax=ax,
             label=f'{nvtx_bin.start:.0f} < $N_{{vtx}}$ < {nvtx_bin.stop:.0f}',
             error_opts=error_opts,
@@ -697,8 +682,7 @@ def compare_turnons(acc, outdir, regions, dataset, distribution='recoil'):
     fig, ax = plt.subplots()
     for region, region_label in regions.items():
         hist.plotratio(
-            h.integrate('region', f'{region}_num'),
-            h.integrate('region', f'{region}_den'),
+            *num_and_den(h, region),
             ax=ax,
             label=region_label,
             error_opts=error_opts,
@@ -739,23 +723,14 @@ def compare_turnons_with_PU60_fill(acc, outdir, region):
 
     # 2022F histograms
     h_2022F = h.integrate("dataset", re.compile("Muon.*2022F"))
-    histograms["2022F"] = {
-        "num" : h_2022F.integrate("region", f"{region}_num"),
-        "den" : h_2022F.integrate("region", f"{region}_den"),
-    }
+    histograms["2022F"] = dict(zip(("num", "den"), num_and_den(h_2022F, region)))
 
     # PU=60 histograms
     h_2022G = h.integrate("dataset", re.compile("Muon.*2022G"))
 
-    histograms["2022G"] = {
-        "num" : h_2022G.integrate("region", f"{region}_num"),
-        "den" : h_2022G.integrate("region", f"{region}_den"),
-    }
+    histograms["2022G"] = dict(zip(("num", "den"), num_and_den(h_2022G, region)))
 
-    histograms["2022G (PU=60)"] = {
-        "num" : h_2022G.integrate("region", f"{region}_highpu_num"),
-        "den" : h_2022G.integrate("region", f"{region}_highpu_den"),
-    }
+    histograms["2022G (PU=60)"] = dict(zip(("num", "den"), num_and_den(h_2022G, f"{region}_highpu")))
 
     # Plot the histograms!
     fig, ax = plt.subplots()
@@ -794,9 +769,10 @@ def compare_turnons_with_PU60_fill(acc, outdir, region):
     plt.close(fig)
 
 
-def compare_metnomu_turnon_for_different_thresh(acc, outdir, regions_num, region_den, dataset='Muon.*2022.*'):
+def compare_metnomu_turnon_for_different_thresh(acc, outdir, regions, dataset='Muon.*2022.*'):
     """
     Compare the METNoMu turn-on for different paths.
+    The regions are given as a mapping (region name -> label), without the _num / _den suffix.
     """
     acc.load("recoil")
     h = acc["recoil"]
@@ -804,10 +780,9 @@ def compare_metnomu_turnon_for_different_thresh(acc, outdir, regions_num, region
     h = h.integrate("dataset", re.compile(dataset))
 
     fig, ax = plt.subplots()
-    for region_num, label in regions_num.items():
+    for region, label in regions.items():
         hist.plotratio(
-            h.integrate("region", region_num),
-            h.integrate("region", region_den),
+            *num_and_den(h, region),
             ax=ax,
             error_opts=error_opts,
             label=label,
@@ -928,14 +903,13 @@ def main():
     # 
     # METNoMu turn-on comparison for different thresholds
     # 
-    regions_num = {
-        f"tr_metnomu{thresh}_filterhf_num" : f"METNo$\\mu$ > {thresh} GeV" for thresh in [110,120,130,140]
+    regions_thresh = {
+        f"tr_metnomu{thresh}_filterhf" : f"METNo$\\mu$ > {thresh} GeV" for thresh in [110,120,130,140]
     }
     # compare_metnomu_turnon_for_different_thresh(
     #     acc, 
     #     outdir,
-    #     regions_num=regions_num,
-    #     region_den="tr_metnomu_filterhf_den",
+    #     regions=regions_thresh,
     #     dataset="Muon.*2022.*"
     # )
 
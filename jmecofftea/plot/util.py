@@ -54,6 +54,24 @@ def rebin_histogram(h: hist.Hist, variable: str) -> hist.Hist:
     
     return h
 
+def num_and_den(h: hist.Hist, region: str, variation: str='nominal'):
+    """
+    Returns the numerator and denominator histograms of the efficiency in the given region.
+
+    Supports both output formats: Separate "<region>_num" and "<region>_den" regions,
+    or a single region "<region>" with a "pass" axis holding the trigger decision
+    (efficiency mode, see RUN.EFFICIENCY_MODE in the configuration).
+
+    If the histogram has a "variation" axis (see JECS.OFFLINE.VARIATIONS in the
+    configuration), the given systematic variation is used.
+    """
+    if 'variation' in [ax.name for ax in h.axes()]:
+        h = h.integrate('variation', variation)
+    if 'pass' in [ax.name for ax in h.axes()]:
+        h_region = h.integrate('region', region)
+        return h_region.integrate('pass', slice(1, 2)), h_region.integrate('pass')
+    return h.integrate('region', f'{region}_num'), h.integrate('region', f'{region}_den')
+
 def get_dataset_tag(dataset: str) -> str:
     mapping = {
         "VBF_HToInv.*" : r"VBF H(inv) 2017",
@@ -0,0 +1,72 @@
+"""Periodic checkpoints of the merged output of a run, to resume it after a crash"""
+
+import os
+import time
+
+from coffea.util import load, save
+from coffea.processor.accumulator import dict_accumulator
+
+# Default time between two checkpoints, in seconds
+DEFAULT_CHECKPOINT_INTERVAL = 300
+
+class CheckpointAccumulator(dict_accumulator):
+    '''
+    Accumulator for the merged output of run_uproot_job_nanoaod(), which writes
+    itself to a checkpoint file while outputs are added, at most every interval seconds.
+
+    The output contains the processor output ("out"), the metrics ("metrics") and
+    the set of completed work items ("done"), so that a resumed run can skip them.
+
+    The checkpoint is first written under a temporary name and then moved,
+    so that the checkpoint file is always complete.
+
+    :param path: Path of the checkpoint file
+    :type path: str
+    :param initial: Output to start from, e.g. loaded from an earlier checkpoint
+    :type initial: dict_accumulator
+    :param interval: Minimum time between two checkpoints, in seconds
+    :type interval: float
+    :param run_info: Settings of the run which a resumed run has to share, e.g. the hash of
+                     the processor configuration and the chunk size. Stored with the checkpoint.
+    :type run_info: dict
+    '''
+    def __init__(self, path, initial, interval=DEFAULT_CHECKPOINT_INTERVAL, run_info=None):
+        super(CheckpointAccumulator, self).__init__(initial)
+        self.path = os.path.abspath(path)
+        self.interval = interval
+        self.run_info = dict(run_info or {})
+        self._last_write = time.time()
+
+    def add(self, other):
+        super(CheckpointAccumulator, self).add(other)
+        if time.time() - self._last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        '''Write the current output to the checkpoint file.'''
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        save({'run_info' : self.run_info, 'output' : dict_accumulator(self)}, tmp)
+        os.replace(tmp, self.path)
+        self._last_write = time.time()
+
+def load_checkpoint(path, run_info=None):
+    '''
+    Load the output stored in a checkpoint file.
+
+    :param path: Path of the checkpoint file
+    :type path: str
+    :param run_info: Settings of the current run, which have to be the same as for the checkpoint
+    :type run_info: dict
+    :return: Output with the keys "out", "metrics" and "done"
+    :rtype: dict_accumulator
+    '''
+    checkpoint = load(path)
+    stored = checkpoint.get('run_info', {})
+    mismatches = [
+        f"{key} ({stored.get(key)!r} instead of {value!r})"
+        for key, value in (run_info or {}).items() if stored.get(key) != value
+    ]
+    if mismatches:
+        raise ValueError(f"Checkpoint {path} was written with a different {', '.join(mismatches)}, cannot resume from it.")
+    return checkpoint['output']
@@ -0,0 +1,133 @@
+"""On-disk cache for the outputs of individual chunks"""
+
+import os
+import glob
+import pickle
+
+import xxhash
+from coffea.util import load, save
+
+from jmecofftea.helpers.paths import jmecofftea_path
+
+pjoin = os.path.join
+
+# Default maximum size of the cache on disk: 10 GB
+DEFAULT_CHUNKCACHE_SIZE = 10 * 1024**3
+
+def source_hash():
+    """
+    Returns a hash of the analysis code and of the input data files that
+    determine the output of a processor: All python files in the package,
+    the JEC text files and the golden JSON files.
+    """
+    patterns = [
+        '**/*.py',
+        'data/jme/*.txt',
+        'data/json/*.txt',
+        'data/json/*.json',
+    ]
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(jmecofftea_path(pattern), recursive=True))
+
+    h = xxhash.xxh64()
+    for fname in sorted(files):
+        h.update(os.path.relpath(fname, jmecofftea_path('.')).encode('utf-8'))
+        with open(fname, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+class ChunkCache(object):
+    '''
+    Content-addressed on-disk cache for the output accumulators of single chunks.
+
+    The key of each entry combines the work item (dataset, file name, tree name,
+    entry range and file UUID), the hash of the analysis code, the hash of
+    the configuration snapshot, the processor class and the options the chunks
+    are processed with (e.g. jmenano, flatten). Any change to one of these leads to a cache miss.
+
+    Entries are evicted in least-recently-used order once the total size
+    exceeds maxsize (in bytes). The access time is tracked via the modification
+    time of the cache files, which is updated on every hit.
+    '''
+    def __init__(self, path, maxsize=DEFAULT_CHUNKCACHE_SIZE, code_hash='', config_hash='',
+                 processor_name='', options=None):
+        self.path = os.path.abspath(path)
+        self.maxsize = maxsize
+        self.code_hash = code_hash
+        self.config_hash = config_hash
+        # Processors share the configuration file, the processor class has to be part of the key
+        self.processor_name = processor_name
+        # Options changing the output of a chunk, in a fixed order
+        self.options = sorted((options or {}).items())
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, item):
+        '''Cache key for the given WorkItem.'''
+        content = [
+            item.dataset,
+            item.filename,
+            item.treename,
+            item.entrystart,
+            item.entrystop,
+            item.fileuuid,
+            self.code_hash,
+            self.config_hash,
+            self.processor_name,
+            self.options,
+        ]
+        return xxhash.xxh64(';'.join(map(str, content)).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return pjoin(self.path, key[:2], f'{key}.coffea')
+
+    def __contains__(self, item):
+        return os.path.exists(self._entry_path(self.key(item)))
+
+    def get(self, item):
+        '''Returns the cached output for the given WorkItem, or None if there is no entry.'''
+        entry = self._entry_path(self.key(item))
+        try:
+            output = load(entry)
+            # Mark the entry as recently used
+            os.utime(entry)
+        except (OSError, EOFError, RuntimeError, pickle.UnpicklingError):
+            return None
+        return output
+
+    def put(self, item, output):
+        '''
+        Saves the output for the given WorkItem. The file is first written under
+        a temporary name and then moved, so that readers never see partial entries.
+        '''
+        entry = self._entry_path(self.key(item))
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = f'{entry}.{os.getpid()}.tmp'
+        save(output, tmp)
+        os.replace(tmp, entry)
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the size of the cache is below maxsize.
+        Returns the number of removed entries.
+        '''
+        entries = []
+        for entry in glob.glob(pjoin(self.path, '*', '*.coffea')):
+            try:
+                stat = os.stat(entry)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, entry in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
@@ -2,9 +2,14 @@
 
 from __future__ import print_function, division
 import concurrent.futures
+import multiprocessing
+import queue
+import threading
 from functools import partial
-from itertools import repeat
+from itertools import repeat, islice
+import os
 import time
+import numpy as np
 import uproot
 import pickle
 import sys
@@ -21,11 +26,19 @@ from coffea.processor.accumulator import (
     value_accumulator,
     set_accumulator,
     dict_accumulator,
+    defaultdict_accumulator,
 )
 from coffea.processor.dataframe import (
     LazyDataFrame,
 )
-from coffea.processor.executor import _normalize_fileset, _get_metadata, dask_executor
+from coffea.processor.executor import _normalize_fileset, _get_metadata, dask_executor, futures_executor
+from jmecofftea.helpers.jme import jec_cache_info
+from jmecofftea.helpers.helpers import lazy_dataframe_internals
+from jmecofftea.helpers.profiling import record_stages
+from jmecofftea.processor.chunkcache import ChunkCache, source_hash, DEFAULT_CHUNKCACHE_SIZE
+from jmecofftea.processor.metadatacache import MetadataCache
+from jmecofftea.processor.filepool import FilePool, DEFAULT_FILEPOOL_SIZE, DEFAULT_FILEPOOL_TIMEOUT
+from jmecofftea.processor.checkpoint import CheckpointAccumulator, load_checkpoint, DEFAULT_CHECKPOINT_INTERVAL
 try:
     from collections.abc import Mapping, Sequence
 except ImportError:
@@ -34,23 +47,109 @@ except ImportError:
 
 _PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
 DEFAULT_METADATA_CACHE = LRUCache(100000)
+# Default memory budget for the columns read ahead in pipeline mode: 1 GB
+DEFAULT_PIPELINE_MEMORY = 1024**3
+
+# Bytes read from xrootd sources by the current thread, see _thread_bytesread()
+_THREAD_BYTESREAD = threading.local()
+
+def _thread_bytesread():
+    return getattr(_THREAD_BYTESREAD, 'value', 0)
 
 # instrument xrootd source
 if not hasattr(uproot.source.xrootd.XRootDSource, '_read_real'):
     def _read(self, chunkindex):
         self.bytesread = getattr(self, 'bytesread', 0) + self._chunkbytes
+        _THREAD_BYTESREAD.value = _thread_bytesread() + self._chunkbytes
         return self._read_real(chunkindex)
 
     uproot.source.xrootd.XRootDSource._read_real = uproot.source.xrootd.XRootDSource._read
     uproot.source.xrootd.XRootDSource._read = _read
 
-def _work_function_nanoaod(item, processor_instance, flatten=False, savemetrics=False,
-                   mmap=False, jmenano=False, cachestrategy=None, skipbadfiles=False,
-                   retries=0, xrootdtimeout=None):
-    if processor_instance == 'heavy':
-        item, processor_instance = item
-    if not isinstance(processor_instance, ProcessorABC):
-        processor_instance = cloudpickle.loads(lz4f.decompress(processor_instance))
+# Per-process cache of the Runs tree summaries, see _runs_summary()
+# Maps (file name, file UUID) -> summary
+_RUNS_SUMMARY_CACHE = LRUCache(1000)
+
+# Open input files, reused for the chunks of the same file processed by this process
+_FILE_POOL = FilePool()
+
+def _configure_file_pool(size, timeout):
+    _FILE_POOL.maxsize = size
+    _FILE_POOL.timeout = timeout
+
+# Thread pool for basket decompression in bulk reads, created once per worker process
+_READ_POOL = None
+
+def _get_read_pool(nthreads):
+    global _READ_POOL
+    if not nthreads or nthreads < 2:
+        return None
+    if _READ_POOL is None or _READ_POOL._max_workers != nthreads:
+        _READ_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=nthreads)
+    return _READ_POOL
+
+class _CountingExecutor(object):
+    '''
+    Wraps the executor passed to uproot, and sums the bytes read from xrootd
+    by the functions it runs. These bytes are read in the threads of the
+    executor, and would otherwise not be attributed to the chunk.
+    '''
+    def __init__(self, executor):
+        self.executor = executor
+        self.bytesread = 0
+        self._lock = threading.Lock()
+
+    def map(self, function, *iterables):
+        def counted(*args):
+            start = _thread_bytesread()
+            try:
+                return function(*args)
+            finally:
+                with self._lock:
+                    self.bytesread += _thread_bytesread() - start
+        return self.executor.map(counted, *iterables)
+
+def _preload_columns(df, columns, executor=None):
+    """
+    Read the given columns for the entry range of the LazyDataFrame in one bulk
+    tree.arrays() call and store them in the data frame. Columns which are not
+    in the tree, or which are already loaded, are skipped.
+    """
+    internals = lazy_dataframe_internals(df)
+    branches = [c for c in sorted(set(columns)) if c in df.available and c not in internals.columns]
+    if not branches:
+        return
+    arrays = internals.tree.arrays(branches, namedecode='utf-8', executor=executor, **internals.branchargs)
+    internals.columns.update(arrays)
+    internals.materialized.update(arrays.keys())
+
+def _estimate_bytes(df, columns):
+    """
+    Estimate the uncompressed size of the given columns for the entry range
+    of the LazyDataFrame, from the total size of the branches in the file.
+    """
+    tree = lazy_dataframe_internals(df).tree
+    if not tree.numentries:
+        return 0
+    total = sum(tree[c].uncompressedbytes() for c in set(columns) if c in df.available)
+    return total * df.size / tree.numentries
+
+def _read_chunk(item, flatten=False, mmap=False, xrootdtimeout=None, columns=None,
+                read_threads=None, memory_budget=None):
+    """
+    Open the input file of a work item and set up the LazyDataFrame for its entry range.
+    The columns declared by the processor are read right away, unless their estimated
+    size exceeds the memory budget (in bytes). In that case they are read on demand.
+
+    The file is taken from the per-process file pool, if it is already open.
+    It has to be given back with _FILE_POOL.release() once the chunk is processed.
+
+    Returns a tuple (file, df, time spent reading, bytes read from xrootd).
+    The bytes are counted for the reads of this call only, also if other
+    threads read from the same file at the same time.
+    """
+    tic = time.time()
+    bytesread_start = _thread_bytesread()
     if mmap:
         localsource = {}
     else:
@@ -60,63 +159,171 @@ def _work_function_nanoaod(item, processor_instance, flatten=False, savemetrics=
         def localsource(path):
             return uproot.FileSource(path, **opts)
 
+    from uproot.source.xrootd import XRootDSource
+    xrootdsource = XRootDSource.defaults
+    xrootdsource['timeout'] = xrootdtimeout
+
+    # Read the input file via uproot3. Convert the content into a LazyDataFrame.
+    file, tree = _FILE_POOL.acquire(
+        key=(item.filename, item.fileuuid, mmap, xrootdtimeout),
+        opener=lambda: uproot.open(item.filename, localsource=localsource, xrootdsource=xrootdsource),
+        treename=item.treename,
+        )
+    try:
+        df = LazyDataFrame(tree, item.entrystart, item.entrystop, flatten=flatten)
+
+        # Read all branches declared by the processor at once,
+        # instead of one request per branch
+        read_pool = _get_read_pool(read_threads)
+        executor = _CountingExecutor(read_pool) if read_pool is not None else None
+        if columns and (memory_budget is None or _estimate_bytes(df, columns) <= memory_budget):
+            _preload_columns(df, columns, executor=executor)
+    except Exception:
+        _FILE_POOL.release(file, discard=True)
+        raise
+
+    bytesread = _thread_bytesread() - bytesread_start
+    if executor is not None:
+        bytesread += executor.bytesread
+    return file, df, time.time() - tic, bytesread
+
+def _work_item_id(item):
+    """Identifier of a WorkItem, which (unlike the WorkItem itself) compares equal across runs."""
+    return (item.dataset, item.filename, item.treename, item.entrystart, item.entrystop, item.fileuuid)
+
+def _runs_summary(file, item):
+    """
+    Summary of the "Runs" tree of the input file of a work item, which is
+    computed only once per file and process, instead of once per chunk.
+
+    The different cases represent the different formats and accordingly
+    different ways of dealing with the provided values:
+    n* branches have to be the same for all runs, their value is kept.
+    genEventSumw(2) have one entry per run, they are summed.
+
+    Returns a mapping branch name -> value.
+    """
+    key = (item.filename, item.fileuuid)
+    if key in _RUNS_SUMMARY_CACHE:
+        return _RUNS_SUMMARY_CACHE[key]
+
+    runs = file['Runs']
+    names = [name.decode('utf-8') for name in runs.keys()]
+    # LHEScaleSumw and LHEPdfSumw are not used
+    names = [name for name in names if name.startswith('n') or any([x in name for x in ['genEventSumw','genEventSumw2']])]
+    arrays = runs.arrays(names, namedecode='utf-8')
+
+    summary = {}
+    for name in names:
+        if name.startswith('n'):
+            # Check that all instances are the same, then save that value
+            values = np.unique(arrays[name])
+            assert(len(values)==1)
+            summary[name] = values[0]
+        else:
+            # One entry per run -> just sum
+            summary[name] = arrays[name].sum()
+
+    _RUNS_SUMMARY_CACHE[key] = summary
+    return summary
+
+def _work_function_nanoaod(item, processor_instance, flatten=False, savemetrics=False,
+                   mmap=False, jmenano=False, cachestrategy=None, skipbadfiles=False,
+                   retries=0, xrootdtimeout=None, chunkcache=None, read_threads=None,
+                   filepool_size=DEFAULT_FILEPOOL_SIZE, filepool_timeout=DEFAULT_FILEPOOL_TIMEOUT,
+                   prefetched=None):
+    """
+    Process a single chunk. If prefetched is given, it is a future holding
+    the result of _read_chunk() for this item, which was read in the background.
+    """
+    if processor_instance == 'heavy':
+        item, processor_instance = item
+    _configure_file_pool(filepool_size, filepool_timeout)
+
+    # If the output for this chunk is already in the on-disk cache, we are done
+    if chunkcache is not None:
+        out = chunkcache.get(item)
+        if out is not None:
+            metrics = dict_accumulator()
+            if savemetrics:
+                metrics['entries'] = value_accumulator(int, item.entrystop - item.entrystart)
+                metrics['chunkcache_hits'] = value_accumulator(int, 1)
+                metrics['chunkcache_misses'] = value_accumulator(int, 0)
+            return dict_accumulator({'out': out, 'metrics': metrics, 'done': set_accumulator({_work_item_id(item)})})
+
+    if not isinstance(processor_instance, ProcessorABC):
+        processor_instance = cloudpickle.loads(lz4f.decompress(processor_instance))
+
     import warnings
     out = processor_instance.accumulator.identity()
     retry_count = 0
     while retry_count <= retries:
+        file = None
+        failed = True
         try:
-            from uproot.source.xrootd import XRootDSource
-            xrootdsource = XRootDSource.defaults
-            xrootdsource['timeout'] = xrootdtimeout
-            
-            # Read the input file via uproot3. Convert the content into a LazyDataFrame.
-            file = uproot.open(item.filename, localsource=localsource, xrootdsource=xrootdsource)
-            tree = file[item.treename]
-            df = LazyDataFrame(tree, item.entrystart, item.entrystop, flatten=flatten)
-            
+            # The time spent waiting for the input is the I/O wait. With a prefetched
+            # chunk, this is only the part of the read that did not overlap with
+            # the processing of the previous chunk.
+            tic = time.time()
+            if prefetched is not None:
+                # Only use the prefetched chunk once, retries read again
+                read, prefetched = prefetched, None
+                file, df, readtime, bytesread = read.result()
+            else:
+                file, df, readtime, bytesread = _read_chunk(item,
+                                                            flatten=flatten,
+                                                            mmap=mmap,
+                                                            xrootdtimeout=xrootdtimeout,
+                                                            columns=getattr(processor_instance, 'columns', None),
+                                                            read_threads=read_threads,
+                                                            )
+            iowait = time.time() - tic
+
             df['dataset'] = item.dataset
             df['filename'] = item.filename
 
             # For NanoAOD, we have to look at the "Runs" TTree for info such as weight sums
-            # The different cases in the loop represent the different formats and accordingly
-            # different ways of dealing with the provided values.
+            # The Runs tree is only read for the first chunk of each file in this process.
             # NOTE: We do not look for "Runs" TTree in JME-custom NTuples (i.e., jmenano=True) 
             if not jmenano:
-                for name in map(lambda x: x.decode('utf-8'), file['Runs'].keys()):
+                for name, value in _runs_summary(file, item).items():
                     if name.startswith('n'):
-                        arr = file['Runs'][name].array()
-                        # Check that all instances are the same, then save that value
-                        tmp = set([])
-                        for entry in arr:
-                            tmp.add(entry)
-                        assert(len(tmp)==1)
-                        df[name] = list(tmp)[0]
-                    elif any([x in name for x in ['genEventSumw','genEventSumw2']]):
-                        arr = file['Runs'][name].array()
-                        # One entry per run -> just sum
-                        df[name] = int(item.entrystart==0) * arr.sum()
-                    elif any([x in name for x in ['LHEScaleSumw','LHEPdfSumw']]):
-                        # # Sum per variation, conserve number of variations
-                        # tmp = 0 * arr[0]
-                        # for i in range(len(arr)):
-                        #     for j in range(len(arr[i])):
-                        #         tmp[j] += arr[i][j]
-                        # df[name] = int(item.entrystart==0) * tmp
-                        pass
+                        df[name] = value
+                    else:
+                        # Weight sums: Only count them once per file
+                        df[name] = int(item.entrystart==0) * value
 
-            tic = time.time()
-            out = processor_instance.process(df)
-            toc = time.time()
+            jec_cache_before = jec_cache_info()
+            with record_stages() as stages:
+                tic = time.time()
+                # Columns which are not read up front are read during the processing
+                bytesread_start = _thread_bytesread()
+                out = processor_instance.process(df)
+                bytesread += _thread_bytesread() - bytesread_start
+                toc = time.time()
+            jec_cache_after = jec_cache_info()
             metrics = dict_accumulator()
             if savemetrics:
                 if isinstance(file.source, uproot.source.xrootd.XRootDSource):
-                    metrics['bytesread'] = value_accumulator(int, file.source.bytesread)
+                    metrics['bytesread'] = value_accumulator(int, bytesread)
                     metrics['dataservers'] = set_accumulator({file.source._source.get_property('DataServer')})
                 metrics['columns'] = set_accumulator(df.materialized)
                 metrics['entries'] = value_accumulator(int, df.size)
                 metrics['processtime'] = value_accumulator(float, toc - tic)
-            wrapped_out = dict_accumulator({'out': out, 'metrics': metrics})
-            file.source.close()
+                metrics['readtime'] = value_accumulator(float, readtime)
+                metrics['iowait'] = value_accumulator(float, iowait)
+                # Time spent in the stages marked within the processor
+                metrics['stages'] = defaultdict_accumulator(float, stages)
+                # Hits and misses of the process-level JEC corrector cache for this chunk
+                metrics['jec_cache_hits'] = value_accumulator(int, jec_cache_after['hits'] - jec_cache_before['hits'])
+                metrics['jec_cache_misses'] = value_accumulator(int, jec_cache_after['misses'] - jec_cache_before['misses'])
+                if chunkcache is not None:
+                    metrics['chunkcache_hits'] = value_accumulator(int, 0)
+                    metrics['chunkcache_misses'] = value_accumulator(int, 1)
+            wrapped_out = dict_accumulator({'out': out, 'metrics': metrics, 'done': set_accumulator({_work_item_id(item)})})
+            if chunkcache is not None:
+                chunkcache.put(item, out)
+            failed = False
             break
         # catch xrootd errors and optionally skip
         # or retry to read the file
@@ -141,16 +348,233 @@ def _work_function_nanoaod(item, processor_instance, flatten=False, savemetrics=
                 metrics['columns'] = set_accumulator({})
                 metrics['entries'] = value_accumulator(int, 0)
                 metrics['processtime'] = value_accumulator(float, 0)
+                metrics['readtime'] = value_accumulator(float, 0)
+                metrics['iowait'] = value_accumulator(float, 0)
+                metrics['stages'] = defaultdict_accumulator(float)
+                metrics['jec_cache_hits'] = value_accumulator(int, 0)
+                metrics['jec_cache_misses'] = value_accumulator(int, 0)
             wrapped_out = dict_accumulator({'out': out, 'metrics': metrics})
         except Exception as e:
             if retries == retry_count:
                 raise e
             w_str = 'Attempt %d of %d. Will retry.' % (retry_count + 1, retries + 1)
             warnings.warn(w_str)
+        finally:
+            # Keep the file open for the next chunks, unless something went wrong
+            if file is not None:
+                _FILE_POOL.release(file, discard=failed)
         retry_count += 1
 
     return wrapped_out
 
+def _work_function_pipelined(items, processor_instance, memory_budget=None, **kwargs):
+    """
+    Process a batch of consecutive chunks in one task, with double buffering:
+    While one chunk is being processed, a background thread reads the declared
+    columns of the next chunk, as long as they fit into the memory budget (in bytes).
+    Returns the sum of the outputs of all chunks in the batch.
+    """
+    if processor_instance == 'heavy':
+        items, processor_instance = items
+    if not isinstance(processor_instance, ProcessorABC):
+        processor_instance = cloudpickle.loads(lz4f.decompress(processor_instance))
+
+    chunkcache = kwargs.get('chunkcache')
+    _configure_file_pool(kwargs.get('filepool_size', DEFAULT_FILEPOOL_SIZE), kwargs.get('filepool_timeout', DEFAULT_FILEPOOL_TIMEOUT))
+    read_args = {
+        'flatten' : kwargs.get('flatten', False),
+        'mmap' : kwargs.get('mmap', False),
+        'xrootdtimeout' : kwargs.get('xrootdtimeout'),
+        'columns' : getattr(processor_instance, 'columns', None),
+        'read_threads' : kwargs.get('read_threads'),
+        'memory_budget' : memory_budget,
+    }
+
+    wrapped_out = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as reader:
+        def prefetch(item):
+            # Nothing to read for chunks that are in the cache
+            if chunkcache is not None and item in chunkcache:
+                return None
+            return reader.submit(_read_chunk, item, **read_args)
+
+        next_read = prefetch(items[0])
+        try:
+            for i, item in enumerate(items):
+                current_read = next_read
+                # The reader thread works on one chunk at a time, so the next chunk
+                # is read while the current one is processed
+                next_read = prefetch(items[i + 1]) if i + 1 < len(items) else None
+                out = _work_function_nanoaod(item, processor_instance, prefetched=current_read, **kwargs)
+                if wrapped_out is None:
+                    wrapped_out = out
+                else:
+                    wrapped_out.add(out)
+        finally:
+            # If processing a chunk failed, the next chunk may already be read,
+            # give its file back to the pool
+            if next_read is not None and not next_read.cancel():
+                try:
+                    file = next_read.result()[0]
+                except Exception:
+                    # _read_chunk() gave the file back already
+                    file = None
+                if file is not None:
+                    _FILE_POOL.release(file)
+
+    return wrapped_out
+
+def _work_function_local(task, work_function, work_queue, processor_instance, flush_interval=None):
+    """
+    Worker-local accumulation: Process items (chunks or batches) taken from a shared
+    queue until it is empty, and fold their outputs into one running accumulator in place.
+    Only this accumulator is sent back, instead of one output per item.
+
+    If flush_interval (in seconds) is given, the accumulator is sent back once this
+    time has passed, and the remaining items are left to the next task.
+    """
+    if not isinstance(processor_instance, ProcessorABC):
+        processor_instance = cloudpickle.loads(lz4f.decompress(processor_instance))
+
+    wrapped_out = None
+    tic = time.time()
+    while flush_interval is None or time.time() - tic < flush_interval:
+        try:
+            item = work_queue.get_nowait()
+        except queue.Empty:
+            break
+        out = work_function(item, processor_instance=processor_instance)
+        if wrapped_out is None:
+            wrapped_out = out
+        else:
+            wrapped_out.add(out)
+
+    if wrapped_out is None:
+        # Nothing left to do for this task, adding an empty output is a no-op
+        return dict_accumulator({'out': dict_accumulator(), 'metrics': dict_accumulator()})
+    return wrapped_out
+
+def _dumps(accumulator, compression):
+    """Pickle an accumulator, compressed with LZ4 at the given level unless it is None."""
+    data = pickle.dumps(accumulator, protocol=_PICKLE_PROTOCOL)
+    if compression is None:
+        return data
+    return lz4f.compress(data, compression_level=compression)
+
+def _loads(data, compression):
+    if compression is not None:
+        data = lz4f.decompress(data)
+    return pickle.loads(data)
+
+def _call_pickled(function, compression, item):
+    """Run the work function for one item, and return its output pickled."""
+    return _dumps(function(item), compression)
+
+def _merge_pickled(compression, first, second):
+    """Add up two pickled outputs, and return the sum pickled."""
+    out = _loads(first, compression)
+    out.add(_loads(second, compression))
+    return _dumps(out, compression)
+
+def futures_tree_executor(items, function, accumulator, **kwargs):
+    """
+    Execute using multiple local cores using python futures, like coffea's futures_executor,
+    but reduce the outputs with a tree of pairwise merges in the worker pool.
+
+    Whenever two outputs (of items or of earlier merges) are available, a task adding them
+    up is submitted to the pool. The outputs stay pickled in the main process, which only
+    unpickles and adds the final sum. The reduction time therefore scales with log(len(items))
+    instead of len(items), and the main process stays responsive.
+
+    Items are submitted from a bounded window of tasks in flight, which is refilled as tasks
+    finish. Merges are submitted as soon as two outputs are available, and do not queue up
+    behind all items. The main process holds at most about window pickled outputs at a time.
+
+    Parameters
+    ----------
+        items : list
+            List of input arguments
+        function : callable
+            A function to be called on each input, which returns an accumulator instance
+        accumulator : AccumulatorABC
+            An accumulator to collect the output of the function
+        pool : concurrent.futures.Executor class or instance, optional
+            The type of futures executor to use, defaults to ProcessPoolExecutor.
+            You can pass an instance instead of a class to re-use an executor
+        workers : int, optional
+            Number of parallel processes for futures (default 1)
+        status : bool, optional
+            If true (default), enable progress bar
+        unit : str, optional
+            Label of progress bar unit (default: 'items')
+        desc : str, optional
+            Label of progress bar description (default: 'Processing')
+        compression : int, optional
+            Compress the outputs in flight with LZ4, at level specified (default 1)
+            Set to ``None`` for no compression.
+        maxinflight : int, optional
+            Maximum number of tasks (items and merges) submitted to the pool at a time
+            (default: twice the number of workers)
+    """
+    if len(items) == 0:
+        return accumulator
+    pool = kwargs.pop('pool', concurrent.futures.ProcessPoolExecutor)
+    workers = kwargs.pop('workers', 1)
+    status = kwargs.pop('status', True)
+    unit = kwargs.pop('unit', 'items')
+    desc = kwargs.pop('desc', 'Processing')
+    compression = kwargs.pop('compression', 1)
+    maxinflight = kwargs.pop('maxinflight', None)
+
+    def reduce(executor):
+        if maxinflight is None:
+            window = 2 * getattr(executor, '_max_workers', workers)
+        else:
+            window = maxinflight
+        window = max(window, 2)
+        remaining = iter(items)
+        pending = set()
+        processing = set()
+        ready = []
+        with tqdm(disable=not status, unit=unit, total=len(items), desc=desc) as progress:
+            while True:
+                # Merge the available outputs pairwise, before more items are submitted
+                while len(ready) >= 2:
+                    pending.add(executor.submit(_merge_pickled, compression, ready.pop(), ready.pop()))
+                # Keep at most window tasks (items and merges) in flight, so that
+                # the pickled outputs held by this process stay bounded
+                for item in islice(remaining, max(window - len(pending), 0)):
+                    future = executor.submit(_call_pickled, function, compression, item)
+                    pending.add(future)
+                    processing.add(future)
+                if not pending:
+                    break
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    ready.append(future.result())
+                    if future in processing:
+                        processing.discard(future)
+                        progress.update(1)
+        return ready.pop()
+
+    if isinstance(pool, concurrent.futures.Executor):
+        result = reduce(pool)
+    else:
+        # assume its a class then
+        with pool(max_workers=workers) as executor:
+            result = reduce(executor)
+    accumulator.add(_loads(result, compression))
+    return accumulator
+
+def _order_by_file(chunks):
+    """
+    Order the chunks by file (in order of the first chunk of each file) and entry range.
+    """
+    files = {}
+    for chunk in chunks:
+        files.setdefault(chunk.filename, []).append(chunk)
+    return [chunk for file_chunks in files.values() for chunk in sorted(file_chunks, key=lambda c: c.entrystart)]
+
 def run_uproot_job_nanoaod(fileset,
                    treename,
                    processor_instance,
@@ -187,10 +611,45 @@ def run_uproot_job_nanoaod(fileset,
             Arguments to pass to executor.  See `iterative_executor`,
             `futures_executor`, `dask_executor`, or `parsl_executor` for available options.
             Some options that affect the behavior of this function:
-            'savemetrics' saves some detailed metrics for xrootd processing (default False);
+            'savemetrics' saves some detailed metrics for xrootd processing (default False),
+            including the time spent in each stage marked with helpers.profiling.stage()
+            within the processor, under metrics['stages'];
             'flatten' removes any jagged structure from the input files (default False);
             'processor_compression' sets the compression level used to send processor instance
-            to workers (default 1).
+            to workers (default 1);
+            'chunkcache' path to a directory used as an on-disk cache of the chunk outputs
+            (default None, no caching). Chunks with unchanged input, code and configuration
+            are loaded from the cache instead of being processed again;
+            'chunkcache_size' maximum size of the chunk cache in bytes (default 10 GB);
+            'pipeline' process batches of consecutive chunks per task, reading the next chunk
+            in the background while the current one is processed (default False);
+            'pipeline_batchsize' number of chunks per batch in pipeline mode (default 10);
+            'pipeline_memory' maximum size in bytes of the columns read ahead for the next chunk
+            (default 1 GB). Chunks exceeding it are read on demand;
+            'read_threads' number of threads used to decompress the baskets when reading
+            the branches declared in the ``columns`` property of the processor (default 4).
+            If the processor declares columns, they are read in one bulk call per chunk;
+            'filepool_size' number of input files each worker process keeps open, so that
+            later chunks of the same file do not open it again (default 4, 0 to disable);
+            'filepool_timeout' time in seconds after which unused files are closed (default 300).
+            The chunks are ordered by file, so that consecutive chunks mostly use the same file;
+            'local_accumulation' run one task per worker, which takes the chunks (or batches
+            in pipeline mode) from a shared queue and sums their outputs in the worker process,
+            so that only one output per worker is sent back and added up (default False).
+            Not available with the dask executor;
+            'local_flush_interval' in local accumulation mode, send the output of a worker back
+            after this many seconds and continue in a new task (default None, only at the end);
+            'tree_reduction' add up the outputs pairwise in the worker pool, see
+            futures_tree_executor(). Only available with the futures executor (default False);
+            'checkpoint' path of a file to which the merged output and the list of completed
+            chunks are written periodically, and at the end of the run (default None, no checkpoints);
+            'checkpoint_interval' minimum time between two checkpoints in seconds (default 300).
+            Checkpoints are written when outputs arrive in the main process, i.e. with local
+            accumulation only every 'local_flush_interval'. Checkpoints are therefore not
+            supported with tree reduction, or with local accumulation without a flush interval;
+            'resume' start from the checkpoint file, if it exists, and skip the chunks
+            completed according to it (default False). The checkpoint has to be written
+            by the same processor, with the same configuration and chunk size.
         pre_executor : callable
             A function like executor, used to calculate fileset metadata
             Defaults to executor
@@ -206,6 +665,9 @@ def run_uproot_job_nanoaod(fileset,
             determine chunking.  Defaults to a in-memory LRU cache that holds 100k entries
             (about 1MB depending on the length of filenames, etc.)  If you edit an input file
             (please don't) during a session, the session can be restarted to clear the cache.
+            If a path is given, the metadata is kept in a persistent sqlite database
+            (see processor.metadatacache.MetadataCache), so that later runs over the
+            same files skip the preprocessing.
     '''
     if not isinstance(fileset, (Mapping, str)):
         raise ValueError("Expected fileset to be a mapping dataset: list(files) or filename")
@@ -218,6 +680,8 @@ def run_uproot_job_nanoaod(fileset,
         pre_args = dict(executor_args)
     if metadata_cache is None:
         metadata_cache = DEFAULT_METADATA_CACHE
+    elif isinstance(metadata_cache, str):
+        metadata_cache = MetadataCache(metadata_cache)
 
     fileset = list(_normalize_fileset(fileset, treename))
     for filemeta in fileset:
@@ -250,9 +714,8 @@ def run_uproot_job_nanoaod(fileset,
             }
             pre_args.update(pre_arg_override)
             pre_executor(to_get, metadata_fetcher, out, **pre_args)
-            while out:
-                item = out.pop()
-                metadata_cache[item] = item.metadata
+            # Store all results at once, a persistent cache writes them in one transaction
+            metadata_cache.update({item : item.metadata for item in out})
             for filemeta in fileset:
                 filemeta.maybe_populate(metadata_cache)
         while fileset:
@@ -286,12 +749,83 @@ def run_uproot_job_nanoaod(fileset,
     jmenano = executor_args.pop('jmenano', False)
     cachestrategy = executor_args.pop('cachestrategy', None)
     pi_compression = executor_args.pop('processor_compression', 1)
+    chunkcache_path = executor_args.pop('chunkcache', None)
+    chunkcache_size = executor_args.pop('chunkcache_size', DEFAULT_CHUNKCACHE_SIZE)
+    read_threads = executor_args.pop('read_threads', 4)
+    pipeline = executor_args.pop('pipeline', False)
+    pipeline_batchsize = executor_args.pop('pipeline_batchsize', 10)
+    pipeline_memory = executor_args.pop('pipeline_memory', DEFAULT_PIPELINE_MEMORY)
+    filepool_size = executor_args.pop('filepool_size', DEFAULT_FILEPOOL_SIZE)
+    filepool_timeout = executor_args.pop('filepool_timeout', DEFAULT_FILEPOOL_TIMEOUT)
+    checkpoint = executor_args.pop('checkpoint', None)
+    checkpoint_interval = executor_args.pop('checkpoint_interval', DEFAULT_CHECKPOINT_INTERVAL)
+    resume = executor_args.pop('resume', False)
+    local_accumulation = executor_args.pop('local_accumulation', False)
+    local_flush_interval = executor_args.pop('local_flush_interval', None)
+    if local_accumulation and executor is dask_executor:
+        raise ValueError("Worker-local accumulation is not supported with the dask executor.")
+    if executor_args.pop('tree_reduction', False):
+        if executor not in (futures_executor, futures_tree_executor):
+            raise ValueError("Tree reduction is only supported with the futures executor.")
+        executor = futures_tree_executor
+    # Checkpoints are written as outputs arrive in the main process. With these
+    # settings, that only happens at the end of the run.
+    if checkpoint is not None and executor is futures_tree_executor:
+        raise ValueError("Checkpoints are not supported with tree reduction.")
+    if checkpoint is not None and local_accumulation and not local_flush_interval:
+        raise ValueError("Checkpoints with local accumulation require a 'local_flush_interval'.")
+    if chunkcache_path is not None:
+        chunkcache = ChunkCache(chunkcache_path,
+                                maxsize=chunkcache_size,
+                                code_hash=source_hash(),
+                                config_hash=getattr(processor_instance, 'config_hash', ''),
+                                processor_name=type(processor_instance).__qualname__,
+                                options={'jmenano' : jmenano, 'flatten' : flatten},
+                                )
+    else:
+        chunkcache = None
     if pi_compression is None:
         pi_to_send = processor_instance
     else:
         pi_to_send = lz4f.compress(cloudpickle.dumps(processor_instance), compression_level=pi_compression)
+    # Keep the chunks of each file together and in order, so that the chunks
+    # a worker gets one after the other find the file in its file pool
+    chunks = _order_by_file(chunks)
+    nchunks_total = len(chunks)
+
+    # A checkpoint can only be resumed by a run with the same settings
+    run_info = {
+        'config_hash' : getattr(processor_instance, 'config_hash', ''),
+        'processor' : type(processor_instance).__qualname__,
+        'chunksize' : chunksize,
+        'align_clusters' : align_clusters,
+    }
+    wrapped_out = dict_accumulator({
+        'out': processor_instance.accumulator.identity(),
+        'metrics': dict_accumulator(),
+        # Identifiers of the work items which have been processed
+        'done': set_accumulator(),
+    })
+    if resume and checkpoint is not None and os.path.exists(checkpoint):
+        wrapped_out = load_checkpoint(checkpoint, run_info)
+        unknown = wrapped_out['done'] - set(_work_item_id(chunk) for chunk in chunks)
+        if unknown:
+            raise ValueError(f"Checkpoint {checkpoint} contains {len(unknown)} chunks which are not part of this run, "
+                             "e.g. because the fileset has changed. Cannot resume from it.")
+        chunks = [chunk for chunk in chunks if _work_item_id(chunk) not in wrapped_out['done']]
+        print(f"Resuming from checkpoint {checkpoint}: {nchunks_total - len(chunks)} of {nchunks_total} chunks are done.")
+    if checkpoint is not None:
+        wrapped_out = CheckpointAccumulator(checkpoint, wrapped_out, interval=checkpoint_interval, run_info=run_info)
+
+    if pipeline:
+        # Batches of consecutive chunks, which mostly belong to the same file
+        items = [chunks[i:i + pipeline_batchsize] for i in range(0, len(chunks), pipeline_batchsize)]
+        work_function = partial(_work_function_pipelined, memory_budget=pipeline_memory)
+    else:
+        items = chunks
+        work_function = _work_function_nanoaod
     closure = partial(
-        _work_function_nanoaod,
+        work_function,
         flatten=flatten,
         savemetrics=savemetrics,
         mmap=mmap,
@@ -300,23 +834,49 @@ def run_uproot_job_nanoaod(fileset,
         skipbadfiles=skipbadfiles,
         retries=retries,
         xrootdtimeout=xrootdtimeout,
+        chunkcache=chunkcache,
+        read_threads=read_threads,
+        filepool_size=filepool_size,
+        filepool_timeout=filepool_timeout,
     )
     # hack around dask/dask#5503 which is really a silly request but here we are
     if executor is dask_executor:
         executor_args['heavy_input'] = pi_to_send
         closure = partial(closure, processor_instance='heavy')
+    elif local_accumulation:
+        # The items are distributed via a shared queue, each task processes
+        # items until the queue is empty (or the flush interval has passed)
+        manager = multiprocessing.Manager()
+        work_queue = manager.Queue()
+        for item in items:
+            work_queue.put(item)
+        closure = partial(_work_function_local,
+                          work_function=closure,
+                          work_queue=work_queue,
+                          processor_instance=pi_to_send,
+                          flush_interval=local_flush_interval,
+                          )
+        # With a flush interval, the number of tasks needed is not known in advance.
+        # Tasks started after the queue is empty return right away.
+        ntasks = len(items) if local_flush_interval else min(executor_args.get('workers', 1), len(items))
+        items = list(range(ntasks))
     else:
         closure = partial(closure, processor_instance=pi_to_send)
 
-    out = processor_instance.accumulator.identity()
-    wrapped_out = dict_accumulator({'out': out, 'metrics': dict_accumulator()})
+    out = wrapped_out['out']
     exe_args = {
-        'unit': 'chunk',
+        'unit': 'task' if local_accumulation else 'batch' if pipeline else 'chunk',
         'function_name': type(processor_instance).__name__,
     }
     exe_args.update(executor_args)
-    executor(chunks, closure, wrapped_out, **exe_args)
-    wrapped_out['metrics']['chunks'] = value_accumulator(int, len(chunks))
+    executor(items, closure, wrapped_out, **exe_args)
+    if local_accumulation:
+        manager.shutdown()
+    if checkpoint is not None:
+        wrapped_out.write()
+    wrapped_out['metrics']['chunks'] = value_accumulator(int, nchunks_total)
+    if chunkcache is not None:
+        chunkcache.evict()
     processor_instance.postprocess(out)
     if savemetrics:
         return out, wrapped_out['metrics']
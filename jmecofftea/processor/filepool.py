@@ -0,0 +1,139 @@
+"""Pool of open input files, reused across the chunks processed by one worker process"""
+
+import time
+import atexit
+import threading
+import multiprocessing.util
+from collections import OrderedDict
+
+# Default number of files kept open per process
+DEFAULT_FILEPOOL_SIZE = 4
+# Default time (in seconds) after which unused files are closed
+DEFAULT_FILEPOOL_TIMEOUT = 300
+
+class FilePool(object):
+    '''
+    Size-bounded pool of open uproot files and their trees.
+
+    Opening a file means an xrootd handshake and reading the file header and
+    streamer infos, and getting the tree means parsing its branch structure.
+    Chunks of a file that is still in the pool skip both.
+
+    Files are handed out with acquire() and have to be given back with release()
+    once the chunk is processed. Files in use are never closed. Of the others,
+    the least recently used are closed once there are more than maxsize open files,
+    and files which have not been used for more than timeout seconds are closed as well.
+
+    All methods are thread-safe, so that files can be opened from the
+    read-ahead thread of the pipeline mode. All files are closed when the
+    process exits, also for worker processes of a multiprocessing pool.
+
+    :param maxsize: Maximum number of open files. With 0, files are closed right after use.
+    :type maxsize: int
+    :param timeout: Time in seconds after which unused files are closed
+    :type timeout: float
+    '''
+    def __init__(self, maxsize=DEFAULT_FILEPOOL_SIZE, timeout=DEFAULT_FILEPOOL_TIMEOUT):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        # Maps key -> entry, in order of last use
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        atexit.register(self.close)
+        # Forked worker processes start with an empty pool, and close it on exit.
+        # Their atexit handlers are not run, but the multiprocessing finalizers are.
+        multiprocessing.util.register_after_fork(self, FilePool._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+    def acquire(self, key, opener, treename):
+        '''
+        Returns the file for the given key and its tree with the given name.
+        If the file is not in the pool, it is opened by calling opener().
+
+        :param key: Key of the file, e.g. the file name and the options used to open it
+        :type key: tuple
+        :param opener: Function opening the file
+        :type opener: callable
+        :param treename: Name of the tree to get from the file
+        :type treename: str
+        :return: Tuple (file, tree)
+        :rtype: tuple
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                entry['users'] += 1
+        if entry is None:
+            # Open outside of the lock, other threads can use the pool in the meantime
+            entry = {'file' : opener(), 'trees' : {}, 'users' : 1, 'used' : time.time()}
+            with self._lock:
+                if key in self._entries:
+                    # Opened by another thread in the meantime, keep both until released
+                    key = (key, id(entry))
+                self._entries[key] = entry
+
+        with self._lock:
+            try:
+                if treename not in entry['trees']:
+                    entry['trees'][treename] = entry['file'][treename]
+            except Exception:
+                # The caller does not get the file, give it back right away
+                entry['users'] -= 1
+                entry['discard'] = True
+                self._sweep()
+                raise
+            tree = entry['trees'][treename]
+            self._sweep()
+        return entry['file'], tree
+
+    def release(self, file, discard=False):
+        '''
+        Give back a file obtained with acquire(). If discard is True,
+        e.g. because reading it failed, the file is closed once it is not used anymore.
+        '''
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry['file'] is file:
+                    entry['users'] -= 1
+                    entry['used'] = time.time()
+                    if discard:
+                        entry['discard'] = True
+                    break
+            self._sweep()
+
+    def _sweep(self):
+        '''Close discarded, idle and least recently used files, if they are not in use.'''
+        now = time.time()
+        unused = [key for key, entry in self._entries.items() if entry['users'] <= 0]
+        nexcess = len(self._entries) - self.maxsize
+        for key in unused:
+            entry = self._entries[key]
+            if nexcess > 0 or entry.get('discard') or now - entry['used'] > self.timeout:
+                self._close(key)
+                nexcess -= 1
+
+    def _close(self, key):
+        entry = self._entries.pop(key)
+        try:
+            entry['file'].source.close()
+        except Exception:
+            pass
+
+    def close(self):
+        '''Close all files, e.g. when the worker process exits.'''
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self._close(key)
@@ -0,0 +1,115 @@
+"""Persistent cache for the file metadata used to determine the chunking"""
+
+import os
+import pickle
+import sqlite3
+from collections.abc import Mapping, MutableMapping
+
+# Default location of the metadata cache
+DEFAULT_METADATA_CACHE_PATH = os.path.expanduser('~/.cache/jmecofftea/metadata.sqlite')
+
+def _is_local(filename):
+    return '://' not in filename or filename.startswith('file://')
+
+def _file_stamp(filename):
+    '''
+    Modification time and size of local files, so that entries for files
+    which have been changed since are not used. Remote files (e.g. on /store/)
+    are not expected to change, and have an empty stamp.
+    '''
+    if not _is_local(filename):
+        return ''
+    path = filename[len('file://'):] if filename.startswith('file://') else filename
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+class MetadataCache(MutableMapping):
+    '''
+    Drop-in replacement for the in-memory metadata cache of run_uproot_job_nanoaod(),
+    which keeps the metadata (number of entries, UUID and, if requested, the cluster
+    boundaries) of each (file, tree) in an sqlite database. Repeated runs over the same
+    files can then skip the preprocessing step, which opens every input file.
+
+    Keys are coffea FileMeta objects (or anything with filename and treename
+    attributes), values are the metadata dictionaries.
+
+    :param path: Path of the sqlite database, created if it does not exist
+    :type path: str
+    '''
+    def __init__(self, path=DEFAULT_METADATA_CACHE_PATH):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connection = None
+
+    @property
+    def connection(self):
+        # Opened on first use, so that the cache can be created without touching the disk
+        if self._connection is None:
+            # Concurrent jobs may share the cache, wait for their writes to finish
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            with self._connection:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS metadata ('
+                    'filename TEXT, treename TEXT, stamp TEXT, metadata BLOB, '
+                    'PRIMARY KEY (filename, treename))'
+                )
+        return self._connection
+
+    def __getstate__(self):
+        # sqlite connections cannot be pickled, the copy opens its own
+        state = dict(self.__dict__)
+        state['_connection'] = None
+        return state
+
+    def __getitem__(self, key):
+        row = self.connection.execute(
+            'SELECT stamp, metadata FROM metadata WHERE filename=? AND treename=?',
+            (key.filename, key.treename)
+        ).fetchone()
+        if row is None or row[0] != _file_stamp(key.filename):
+            raise KeyError(key)
+        return pickle.loads(row[1])
+
+    def __setitem__(self, key, metadata):
+        self.update({key: metadata})
+
+    def update(self, entries):
+        '''Store the metadata for all given keys in one transaction.'''
+        if isinstance(entries, Mapping):
+            entries = entries.items()
+        rows = [
+            (key.filename, key.treename, _file_stamp(key.filename), pickle.dumps(metadata))
+            for key, metadata in entries
+        ]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)', rows)
+
+    def __delitem__(self, key):
+        with self.connection:
+            cursor = self.connection.execute(
+                'DELETE FROM metadata WHERE filename=? AND treename=?',
+                (key.filename, key.treename)
+            )
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def __iter__(self):
+        # Keys are (filename, treename) tuples, not the FileMeta objects they were stored with
+        for filename, treename in self.connection.execute('SELECT filename, treename FROM metadata'):
+            yield (filename, treename)
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+
+    def __bool__(self):
+        # FileMeta.maybe_populate() checks the truth value for every file,
+        # avoid counting the rows of the table each time
+        return True
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
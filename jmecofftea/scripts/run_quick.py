@@ -6,11 +6,13 @@ from jmecofftea.helpers.cutflow import print_cutflow
 from coffea.util import save
 import coffea.processor as processor
 import argparse
+import os
 
 def parse_commandline():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('processor', type=str, help='The processor to be run. (monojet or vbfhinv)')
+    parser.add_argument('--resume', action='store_true', default=False, help='Continue from the checkpoint of an earlier run, skipping the chunks which are already done.')
     args = parser.parse_args()
 
     return args
@@ -64,14 +66,17 @@ def main():
         print(f"Number of files: {len(filelist)}")
         tmp = {dataset:filelist}
 
+        # Periodic checkpoints of the output, to continue with --resume after a crash
+        checkpoint = f"{processor_class}_{dataset}.checkpoint"
         output = run_uproot_job_nanoaod(tmp,
                                     treename=treename,
                                     processor_instance=processorInstance,
                                     executor=processor.futures_executor,
-                                    executor_args=executor_args,
+                                    executor_args=dict(executor_args, checkpoint=checkpoint, resume=args.resume),
                                     chunksize=500000,
                                     )
         save(output, f"{processor_class}_{dataset}.coffea")
+        os.remove(checkpoint)
         # Debugging / testing output
         # debug_plot_output(output)
         print_cutflow(output, outfile=f'{processor_class}_cutflow_{dataset}.txt')